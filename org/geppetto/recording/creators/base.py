@@ -38,9 +38,12 @@ class RecordingCreator:
     Create one instance of this class per recording file.
     Add values for different types of variables with `add_values`. Successive values for one variable can be provided
     as an iterable or by calling `add_values` multiple times. If you store state variables that are associated with
-    time, call either `set_time_step` or `add_time_points`. Add global metadata for the recording with `add_metadata`.
+    time, call either `set_time_step` or `add_time_points`. State variables that are sampled at other time points can
+    refer to an additional time axis (see the `time_axis` parameter of `add_values` and `add_time_points`).
+    Add global metadata for the recording with `add_metadata`.
     All these methods will return the `RecordingCreator` itself, so the calls can be chained.
-    If finished, call `create` to write all data to an HDF5 file.
+    If finished, call `create` to write all data to an HDF5 file. To keep memory consumption low for long recordings,
+    call `flush` in between to write the values added so far to the file.
 
     Parameters
     ----------
@@ -79,14 +82,22 @@ class RecordingCreator:
         self.time_points = None
         self.time_step = None
         self.time_unit = None
+        self.time_axes = {}
+        self.time_axis_units = {}
+        self.variable_time_axes = {}
+        self.dataset_options = {}  # extra arguments for h5py's create_dataset by variable name, like compression
         self.simulator = simulator
         self.metadata = {}
+        self.flushed_lengths = {}
+        self.num_flushed_time_points = 0
+        self.num_flushed_time_axis_points = {}
+        self.flushed = False
         self.created = False
 
     def __repr__(self):
         r = 'Recording creator for ' + self.filename + ' (simulator: ' + self.simulator + ', variables: ' + str(len(self.values))
         if self.time_points is not None:
-            r += ', time points:' + str(len(self.time_points))
+            r += ', time points:' + str(self.num_flushed_time_points + len(self.time_points))
         elif self.time_step is not None:
             r += ', fixed time step'
         else:
@@ -113,7 +124,32 @@ class RecordingCreator:
             i += 1
         return 1
 
-    def add_values(self, name, values, unit=None, meta_type=None, is_single_value=False, custom_metadata=None):
+    @staticmethod
+    def _append(stored, values, is_single_value=False):
+        """Append `values` to stored values or time points and return the result.
+
+        Stored values are kept in a list. A NumPy array is stored as an array instead (and concatenated with further
+        values), so its elements never have to be converted to Python objects one by one.
+
+        """
+        if hasattr(values, '__iter__') and not is_single_value:
+            # TODO: Can cause memory errors for many steps, especially on 32-bit versions of Python
+            # (depending on the OS, there are only 1 to 4 GB of memory available).
+            # TODO: Possible long-term solution: Flush values to hdf5 file if they extend a certain size or
+            # if a MemoryError is excepted.
+            if isinstance(values, np.ndarray) and not len(stored):
+                return np.array(values)  # copy, because the caller may reuse or release the memory of `values`
+            elif isinstance(stored, np.ndarray):
+                return np.concatenate((stored, values))
+            stored.extend(values)
+        else:
+            if isinstance(stored, np.ndarray):
+                stored = stored.tolist()
+            stored.append(values)
+        return stored
+
+    def add_values(self, name, values, unit=None, meta_type=None, is_single_value=False, custom_metadata=None,
+                   time_axis=None):
         """Add one or multiple values for a variable to the recording.
 
         If values for this variable were added before, the new values will be appended. In this case, you can
@@ -127,6 +163,7 @@ class RecordingCreator:
         values : number or any iterable of numbers
             One or multiple values of the variable. Will be appended to existing values. If `meta_type` is
             STATE_VARIABLE and `values` is iterable, its elements will be associated with successive time points.
+            NumPy arrays are stored as arrays, which is much faster and needs less memory than other iterables.
         unit : string, optional
             The unit of the variable. If `None` (default), the unit from a previous definition of this variable
             will be used.
@@ -136,6 +173,9 @@ class RecordingCreator:
         is_single_value : boolean, optional
             If `True`, `values` will be stored as a single value for a single time point, even if it is iterable. 
             (Be aware that HDF View visualizes such multi dimensional data in a pretty unintuitive way)
+        time_axis : string, optional
+            The name of an additional time axis (see `add_time_points`) the values are associated with. If `None`
+            (default), the values are associated with the main time points or time step of the recording.
 
         Returns
         -------
@@ -153,21 +193,16 @@ class RecordingCreator:
             self.units[name] = unit
             self.custom_metadata[name] = custom_metadata
             self.meta_types[name] = meta_type
+            self.variable_time_axes[name] = time_axis
         else:
             if meta_type is not None and meta_type != self.meta_types[name]:
                 raise ValueError("Meta type does not match with a previous definition of this variable")
             if unit is not None and unit != self.units[name]:
                 raise ValueError("Unit does not match with a previous definition of this variable")
+            if time_axis is not None and time_axis != self.variable_time_axes[name]:
+                raise ValueError("Time axis does not match with a previous definition of this variable")
 
-        if hasattr(values, '__iter__') and not is_single_value:
-            # TODO: Can cause memory errors for many steps, especially on 32-bit versions of Python
-            # (depending on the OS, there are only 1 to 4 GB of memory available).
-            # TODO: Possible long-term solution: Flush values to hdf5 file if they extend a certain size or
-            # if a MemoryError is excepted.
-            self.values[name].extend(values)
-        else:
-            self.values[name].append(values)
-
+        self.values[name] = self._append(self.values[name], values, is_single_value)
         return self
 
     def add_metadata(self, name, value):
@@ -225,11 +260,13 @@ class RecordingCreator:
         self.time_unit = unit
         return self
 
-    def add_time_points(self, time_points, unit=None):
+    def add_time_points(self, time_points, unit=None, time_axis=None):
         """Add one or multiple time points for all state variables in the recording.
 
         If other time points were added before, the new ones will be appended. In this case, you can
         omit the `unit` and `meta_type` parameters. Call only one of `set_time_step` and `add_time_points`.
+        If `time_axis` is given, the time points are added to an additional time axis instead, which is only used by
+        the variables that refer to it. Additional time axes can be combined with `set_time_step`.
 
         Parameters
         ----------
@@ -238,6 +275,9 @@ class RecordingCreator:
         unit : string, optional
             The unit of the time points. If `None` (default), the unit from a previous definition of time points
             will be used.
+        time_axis : string, optional
+            The name of an additional time axis (for example *time_1ms*), which will be stored as a separate
+            dataset. If `None` (default), the time points are added to the main time points of the recording.
 
         Returns
         -------
@@ -250,6 +290,16 @@ class RecordingCreator:
 
         """
         self._assert_not_created()
+        if time_axis is not None:
+            if not time_axis or time_axis == 'time':
+                raise ValueError("Invalid name for a time axis: " + str(time_axis))
+            if time_axis not in self.time_axes:
+                self.time_axes[time_axis] = []
+                self.time_axis_units[time_axis] = unit
+            elif unit is not None and unit != self.time_axis_units[time_axis]:
+                raise ValueError("Unit does not match with a previous definition of this time axis")
+            self.time_axes[time_axis] = self._append(self.time_axes[time_axis], time_points)
+            return self
         if self.time_step is not None:
             raise RuntimeError("Previous call to set_time_step, use only one of add_time_points and set_time_step")
         if self.time_points is None:
@@ -258,12 +308,76 @@ class RecordingCreator:
         else:
             if unit is not None and unit != self.time_unit:
                 raise ValueError("Unit does not match with a previous definition of time points")
-        if hasattr(time_points, '__iter__'):
-            self.time_points.extend(time_points)
+        self.time_points = self._append(self.time_points, time_points)
+        return self
+
+    @staticmethod
+    def _append_to_dataset(f, path, values):
+        """Append `values` along the first axis of the dataset at `path`, create a resizable dataset if needed."""
+        values = np.asarray(values)
+        if path in f:
+            if len(values):
+                dataset = f[path]
+                dataset.resize(len(dataset) + len(values), axis=0)
+                dataset[-len(values):] = values
         else:
-            self.time_points.append(time_points)
+            f.create_dataset(path, data=values, maxshape=(None,) + values.shape[1:], chunks=True)
+
+    def flush(self):
+        """Write all values and time points added so far to the recording file and remove them from memory.
+
+        Values and time points that are added afterwards will be appended to the ones in the file. Units, meta types
+        and metadata are still written by `create`, which has to be called at the end as usual.
+
+        Returns
+        -------
+        RecordingCreator
+            The creator itself, to allow chained method calls.
+
+        """
+        self._assert_not_created()
+        with h5py.File(self.filename, 'a' if self.flushed else 'w') as f:  # overwrite a previous file on first flush
+            for name in self.values.keys():
+                self._append_to_dataset(f, name.replace('.', '/'), self.values[name])
+                self.flushed_lengths[name] = self.flushed_lengths.get(name, 0) + len(self.values[name])
+                self.values[name] = []
+            if self.time_points is not None:
+                self._append_to_dataset(f, 'time', self.time_points)
+                self.num_flushed_time_points += len(self.time_points)
+                self.time_points = []
+            for time_axis in self.time_axes.keys():
+                self._append_to_dataset(f, time_axis, self.time_axes[time_axis])
+                self.num_flushed_time_axis_points[time_axis] = (self.num_flushed_time_axis_points.get(time_axis, 0) +
+                                                                len(self.time_axes[time_axis]))
+                self.time_axes[time_axis] = []
+        self.flushed = True
         return self
 
+    def _add_recording_file(self, filename):
+        """Add all values, time points and metadata of an existing recording file (created by `create`)."""
+        with h5py.File(filename, 'r') as f:
+            for name, value in f.attrs.iteritems():
+                if name != 'simulator':
+                    self.add_metadata(name, value)
+            datasets = []
+            f.visititems(lambda path, obj: datasets.append((path, obj)) if isinstance(obj, h5py.Dataset) else None)
+            for path, dataset in datasets:
+                values = dataset[()]
+                unit = dataset.attrs.get('unit')
+                if 'meta_type' not in dataset.attrs:  # time points
+                    if path == 'time':
+                        self.add_time_points(values, unit)
+                    else:
+                        self.add_time_points(values, unit, time_axis=path)
+                    continue
+                meta_type = dataset.attrs['meta_type']
+                custom_metadata = dataset.attrs['custom_metadata']
+                self.add_values(path.replace('/', '.'), values, unit,
+                                None if meta_type == 'None' else MetaType[meta_type.split('.')[1]],
+                                is_single_value=np.ndim(values) == 0,
+                                custom_metadata=None if custom_metadata == 'None' else custom_metadata,
+                                time_axis=dataset.attrs.get('time_axis'))
+
     def create(self):
         """Create the recording file and write all data to it.
 
@@ -271,7 +385,7 @@ class RecordingCreator:
 
         """
         self._assert_not_created()
-        with h5py.File(self.filename, 'w') as f:  # overwrite a previous file
+        with h5py.File(self.filename, 'a' if self.flushed else 'w') as f:  # overwrite a previous file
             # print 'Writing file...'
             # start_time = time.time()
             self._process_added_data(f)
@@ -285,29 +399,62 @@ class RecordingCreator:
             f.attrs[name] = value
 
         max_num_steps = 0
+        max_num_steps_per_time_axis = dict.fromkeys(self.time_axes, 0)
         for name in self.values:
             if self.meta_types[name] == MetaType.STATE_VARIABLE:
-                max_num_steps = max(max_num_steps, len(self.values[name]))
+                num_steps = self.flushed_lengths.get(name, 0) + len(self.values[name])
+                time_axis = self.variable_time_axes[name]
+                if time_axis is None:
+                    max_num_steps = max(max_num_steps, num_steps)
+                elif time_axis in max_num_steps_per_time_axis:
+                    max_num_steps_per_time_axis[time_axis] = max(max_num_steps_per_time_axis[time_axis], num_steps)
+                else:
+                    raise RuntimeError("No time points were added for time axis {0} of variable {1}".format(time_axis, name))
 
         if self.time_points is not None and self.time_step is not None:  # this should normally not happen
             raise RuntimeError("You added both time points and a time step, use only one")
         if self.time_points is None and self.time_step is None and max_num_steps:
             raise RuntimeError("You added state variables, please also add time points or set a time step")
         if self.time_points is not None:
-            if len(self.time_points) < max_num_steps:
+            if self.num_flushed_time_points + len(self.time_points) < max_num_steps:
                 raise IndexError("There are not enough time points to cover the values of all state variables")
-            f['time'] = self.time_points
+            if 'time' in f:  # time points were flushed before
+                self._append_to_dataset(f, 'time', self.time_points)
+            else:
+                f['time'] = self.time_points
             f['time'].attrs['unit'] = self.time_unit
         elif self.time_step is not None:
             f['time'] = np.linspace(0, max_num_steps * self.time_step, max_num_steps, endpoint=False)
             f['time'].attrs['unit'] = self.time_unit
 
+        for time_axis, time_points in self.time_axes.iteritems():
+            if self.num_flushed_time_axis_points.get(time_axis, 0) + len(time_points) < max_num_steps_per_time_axis[time_axis]:
+                raise IndexError("There are not enough time points in time axis {0} to cover the values of its state variables".format(time_axis))
+            if time_axis in f:  # time points were flushed before
+                self._append_to_dataset(f, time_axis, time_points)
+            else:
+                f[time_axis] = time_points
+            f[time_axis].attrs['unit'] = self.time_axis_units[time_axis]
+
         for name in self.values.keys():
             path = name.replace('.', '/')
             try:
-                f[path] = self.values[name]
+                if name in self.flushed_lengths:
+                    self._append_to_dataset(f, path, self.values[name])
+                elif (np.ndim(self.values[name]) > 2 and isinstance(self.values[name], np.ndarray) and
+                      len(self.values[name])):
+                    # one chunk per frame (e.g. all transformation matrices of a time step), to read them one by one
+                    f.create_dataset(path, data=self.values[name], chunks=(1,) + self.values[name].shape[1:],
+                                     **self.dataset_options.get(name, {}))
+                elif np.ndim(self.values[name]) > 1 and isinstance(self.values[name], np.ndarray):
+                    # to read parts of large matrices
+                    f.create_dataset(path, data=self.values[name], chunks=True, **self.dataset_options.get(name, {}))
+                else:
+                    f[path] = self.values[name]
                 f[path].attrs['unit'] = self.units[name]
                 f[path].attrs['custom_metadata'] = str(self.custom_metadata[name])
                 f[path].attrs['meta_type'] = str(self.meta_types[name])
+                if self.variable_time_axes[name] is not None:
+                    f[path].attrs['time_axis'] = self.variable_time_axes[name]
             except RuntimeError:
                 raise ValueError("Cannot write dataset for variable: " + name)
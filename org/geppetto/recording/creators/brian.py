@@ -1,4 +1,6 @@
 from __future__ import absolute_import
+import re
+import time
 import numpy as np
 from org.geppetto.recording.creators import utils
 from org.geppetto.recording.creators.base import RecordingCreator, MetaType
@@ -17,6 +19,54 @@ def _assert_brian_imported():
         raise ImportError("Could not import brian, install it to proceed (see README for instructions)")
 
 
+# Length of one time step in seconds for the units in the header of AER files.
+_AER_TICK_UNITS = {'s': 1, 'second': 1, 'ms': 1e-3, 'msecond': 1e-3, 'us': 1e-6, 'usecond': 1e-6,
+                   'ns': 1e-9, 'nsecond': 1e-9}
+
+
+def _read_aer(filename):
+    """Return the addresses (neuron indices) and times (in seconds) of all events in an AER file (.aedat or .dat).
+
+    Works like `brian.load_aer` (with its default arguments), but does not need to import brian.
+
+    """
+    with open(filename, 'rb') as f:
+        content = f.read()
+    version = 1
+    tick = 1e-6
+    position = 0
+    while content.startswith('#', position):  # header lines
+        end = content.find('\n', position)
+        end = len(content) if end == -1 else end + 1
+        line = content[position:end].strip()
+        position = end
+        if line.startswith('#!AER-DAT'):
+            version = int(float(line[9:]))
+        elif line.startswith('# Timestamps tick is '):
+            match = re.match(r'([0-9.eE+-]+)\s*\*?\s*(\w+)$', line[21:])
+            if match is None or match.group(2) not in _AER_TICK_UNITS:
+                raise IOError("Could not parse AER file, unknown timestamp tick: " + line[21:])
+            tick = float(match.group(1)) * _AER_TICK_UNITS[match.group(2)]
+    # Events are big endian (address, timestamp) pairs, addresses have 2 bytes in version 1 and 4 bytes in version 2.
+    event_dtype = np.dtype([('address', '>i2' if version == 1 else '>i4'), ('timestamp', '>i4')])
+    if (len(content) - position) % event_dtype.itemsize:
+        raise IOError("Could not parse AER file, timestamps and addresses don't have the same lengths: " + filename)
+    events = np.frombuffer(content, event_dtype, offset=position)
+    return events['address'].astype(int), events['timestamp'] * tick
+
+
+def _parse_spike_text(text, filename):
+    """Return the neuron indices and times of the spikes in the text of a FileSpikeMonitor file."""
+    # Each line is "index, time", parse all of them at once.
+    text = text.replace(',', ' ')
+    data = np.fromstring(text, sep=' ')
+    # fromstring stops silently at the first value that is not a number
+    if len(data) != len(text.split()) or len(data) % 2:
+        raise IOError("Could not parse FileSpikeMonitor file: " + filename)
+    data = data.reshape(-1, 2)
+    return data[:, 0].astype(int), data[:, 1]
+
+
 class BrianRecordingCreator(RecordingCreator):
     """
     A RecordingCreator which interfaces to the Brian spiking neural network simulator (www.briansimulator.org).
@@ -44,12 +94,24 @@ class BrianRecordingCreator(RecordingCreator):
 
     def __init__(self, filename, overwrite=False):
         RecordingCreator.__init__(self, filename, 'Brian', overwrite)
+        self.population_activity_options = {}
+
+    def _add_spike_trains(self, indices, times, unformatted_variable_name):
+        """Add spike times of multiple neurons, with one call to `add_values` per neuron (keeps the order of times)."""
+        if not len(indices):  # no spikes
+            return
+        order = np.argsort(indices, kind='mergesort')  # stable, so the spike times of each neuron stay in order
+        indices = indices[order]
+        times = times[order]
+        boundaries = np.flatnonzero(np.diff(indices)) + 1
+        for neuron_indices, neuron_times in zip(np.split(indices, boundaries), np.split(times, boundaries)):
+            self.add_values(unformatted_variable_name.format(neuron_indices[0]), neuron_times, 'ms', MetaType.EVENT)
 
     def add_recording(self, recording_filename, neuron_group_name=None):
         """Read a recording file from the Brian simulator and add its contents to the current recording.
 
         The recording file may be created using `brian.FileSpikeMonitor` (text format) or `brian.AERSpikeMonitor`
-        (binary format).
+        (binary format). Both formats are read without importing brian.
 
         Parameters
         ----------
@@ -74,24 +136,88 @@ class BrianRecordingCreator(RecordingCreator):
         if is_text_file(recording_filename):  # text format from FileSpikeMonitor
             with open(recording_filename, 'r') as r:
                 file_content = r.read()
-            for i, line in enumerate(file_content.splitlines()):
-                colon = line.find(',')
-                index = int(line[:colon])
-                time = float(line[colon+2:])
-                self.add_values(unformatted_variable_name.format(index), time, 'ms', MetaType.EVENT)
+            indices, times = _parse_spike_text(file_content, recording_filename)
+            self._add_spike_trains(indices, times, unformatted_variable_name)
         else:  # binary format from AERSpikeMonitor
-            _assert_brian_imported()
-            try:
-                indices, times = brian.load_aer(recording_filename)
-            except Exception as e:
-                raise IOError("Could not parse AER file: " + e.message)
-            if len(indices) == 0 or len(times) == 0:
+            indices, times = _read_aer(recording_filename)
+            if len(indices) == 0:
                 raise RuntimeError("Could not parse AER file or is empty: " + recording_filename)
-            for index, time in zip(indices, times):
-                self.add_values(unformatted_variable_name.format(index), time, 'ms', MetaType.EVENT)
+            self._add_spike_trains(indices, times, unformatted_variable_name)
+        return self
+
+    def follow_recording(self, recording_filename, neuron_group_name=None, sentinel=None, timeout=None,
+                         process=None, poll_interval=0.1):
+        """Add the spikes of a FileSpikeMonitor file while Brian is still writing it.
+
+        The file is read repeatedly from the position where the previous read stopped, and the spikes in all new
+        complete lines are added to the recording (the file does not have to exist yet). This blocks until one of
+        the stop conditions below is met, at least one of them must be given.
+
+        Parameters
+        ----------
+        recording_filename : string
+            Path to the file of the FileSpikeMonitor (text format).
+        neuron_group_name : string, optional
+            Name of the NeuronGroup the recording file belongs to (see `add_recording`).
+        sentinel : string, optional
+            A line that marks the end of the file (like *END*). Stop when this line was read.
+        timeout : float, optional
+            Stop if no new data arrived for this many seconds.
+        process : subprocess.Popen, optional
+            The process that writes the file (or any object with a `poll` method that returns `None` while it is
+            running). Stop after the process has exited and the rest of the file was read.
+        poll_interval : float, optional
+            Time to wait between two reads if no new data arrived, in seconds (default: 0.1).
+
+        Returns
+        -------
+        BrianRecordingCreator
+            The creator itself, to allow chained method calls.
+
+        """
+        self._assert_not_created()
+        if sentinel is None and timeout is None and process is None:
+            raise ValueError("Give a sentinel, timeout or process to stop following the file")
+
+        unformatted_variable_name = 'neuron{0}.spikes'
+        if neuron_group_name:
+            unformatted_variable_name = neuron_group_name + '.' + unformatted_variable_name
+
+        offset = 0
+        last_data_time = time.time()
+        while True:
+            process_finished = process is not None and process.poll() is not None  # check first, then read the rest
+            new_content = ''
+            if os.path.exists(recording_filename):
+                with open(recording_filename, 'rb') as r:
+                    r.seek(offset)
+                    new_content = r.read()
+            # Leave an incomplete last line for the next read, unless nothing will be written anymore.
+            end = len(new_content) if process_finished else new_content.rfind('\n') + 1
+            new_lines = new_content[:end]
+            offset += end
+
+            sentinel_found = False
+            if sentinel is not None:
+                match = re.search('^' + re.escape(sentinel) + r'\r?$', new_lines, re.MULTILINE)
+                if match is not None:
+                    new_lines = new_lines[:match.start()]
+                    sentinel_found = True
+            if new_lines.strip():
+                indices, times = _parse_spike_text(new_lines, recording_filename)
+                self._add_spike_trains(indices, times, unformatted_variable_name)
+            if end:
+                last_data_time = time.time()
+
+            if sentinel_found or process_finished:
+                break
+            if timeout is not None and time.time() - last_data_time > timeout:
+                break
+            if not end:
+                time.sleep(poll_interval)
         return self
 
-    def add_spike_monitor(self, spike_monitor, neuron_group_name=None):
+    def add_spike_monitor(self, spike_monitor, neuron_group_name=None, neurons=None):
         """Add all spike times in a SpikeMonitor from Brian to the recording.
 
         Parameters
@@ -101,6 +227,8 @@ class BrianRecordingCreator(RecordingCreator):
         neuron_group_name : string, optional
             Name of the NeuronGroup the monitor belongs to. If supplied, the values will be stored as
             neuron_group_name.neuron123.variable, otherwise as neuron123.variable.
+        neurons : iterable of ints, optional
+            Indices of the neurons whose spike times to add. If `None` (default), add the spike times of all neurons.
 
         Returns
         -------
@@ -116,11 +244,14 @@ class BrianRecordingCreator(RecordingCreator):
         unformatted_name = 'Neuron{0}.spikes'
         if neuron_group_name:
             unformatted_name = neuron_group_name + '.' + unformatted_name
+        if neurons is not None:
+            neurons = set(neurons)
         for neuron_index, spike_times in spike_monitor.spiketimes.iteritems():
-            self.add_values(unformatted_name.format(neuron_index), spike_times, 'ms', MetaType.EVENT)
+            if neurons is None or neuron_index in neurons:
+                self.add_values(unformatted_name.format(neuron_index), spike_times, 'ms', MetaType.EVENT)
         return self
 
-    def add_state_monitor(self, state_monitor, neuron_group_name=None):
+    def add_state_monitor(self, state_monitor, neuron_group_name=None, as_matrix=False):
         """Add all values and time points in a StateMonitor from Brian to the recording.
 
         Parameters
@@ -130,6 +261,11 @@ class BrianRecordingCreator(RecordingCreator):
         neuron_group_name : string, optional
             Name of the NeuronGroup the monitor belongs to. If supplied, the values will be stored as
             neuron_group_name.neuron123.variable, otherwise as neuron123.variable.
+        as_matrix : boolean, optional
+            If `True`, store the values of all neurons as a single (time points x neurons) STATE_VARIABLE named like
+            neuron_group_name.variable, and the indices of the recorded neurons (one per column) as a PROPERTY named
+            like neuron_group_name.variable_neuron_indices. This creates far fewer datasets for large groups, which
+            makes the file faster to write and to open. If `False` (default), store one variable per neuron.
 
         Returns
         -------
@@ -159,14 +295,25 @@ class BrianRecordingCreator(RecordingCreator):
                         raise ValueError("StateMonitor has different time points than already defined (maybe you were adding a group after running?)")
 
         unit = str(state_monitor.unit)[4:]  # state_monitor.unit is something like 1 * V
+        if as_matrix:
+            name = state_monitor.varname
+            if neuron_group_name:
+                name = neuron_group_name + '.' + name
+            if not self._variable_exists(name + '_neuron_indices'):
+                self.add_values(name + '_neuron_indices', np.asarray(state_monitor.get_record_indices()), '',
+                                MetaType.PROPERTY)
+            # The monitor stores a (neurons x time points) array, its transpose is only a view.
+            self.add_values(name, state_monitor.values.T, unit, MetaType.STATE_VARIABLE)
+            return self
         unformatted_name = 'Neuron{0}.' + state_monitor.varname
         if neuron_group_name:
             unformatted_name = neuron_group_name + '.' + unformatted_name
-        for neuron_index, values in enumerate(state_monitor):
+        # The rows of the values belong to the recorded neurons (which are not all neurons, if `record` is a list).
+        for neuron_index, values in zip(state_monitor.get_record_indices(), state_monitor.values):
             self.add_values(unformatted_name.format(neuron_index), values, unit, MetaType.STATE_VARIABLE)
         return self
 
-    def add_multi_state_monitor(self, multi_state_monitor, neuron_group_name=None):
+    def add_multi_state_monitor(self, multi_state_monitor, neuron_group_name=None, as_matrix=False):
         """Add all values and time points in a MultiStateMonitor from Brian to the recording.
 
         Parameters
@@ -176,6 +323,8 @@ class BrianRecordingCreator(RecordingCreator):
         neuron_group_name : string, optional
             Name of the NeuronGroup the monitor belongs to. If supplied, the values will be stored as
             neuron_group_name.neuron123.variable, otherwise as neuron123.variable.
+        as_matrix : boolean, optional
+            If `True`, store one matrix per variable instead of one variable per neuron (see `add_state_monitor`).
 
         Returns
         -------
@@ -191,10 +340,51 @@ class BrianRecordingCreator(RecordingCreator):
         for state_monitor in multi_state_monitor.monitors.values():
             # TODO: Can cause memory errors if the state_monitor has many values.
             # Iterating over state_monitor._values solves this, but does not give the correct number of values.
-            self.add_state_monitor(state_monitor, neuron_group_name)
+            self.add_state_monitor(state_monitor, neuron_group_name, as_matrix)
         return self
 
-    def record_model(self, model_filename):
+    def add_population_activity(self, bin_widths, smoothing_width=None, per_neuron=True):
+        """Add spike counts and firing rates of all neuron groups, computed from their spike times in `create`.
+
+        For each neuron group (all spike variables named like *neuron_group_name.neuron123.spikes*) and each bin
+        width, the following STATE_VARIABLEs are added on a time axis with the start times of the bins, named like
+        *time_bins_0_001* for a bin width of 0.001:
+
+        - *neuron_group_name.population_spike_counts_0_001*: The number of spikes of all neurons in each bin.
+        - *neuron_group_name.population_rate_0_001*: The spike count divided by the number of neurons and the bin
+          width (optionally smoothed, see `smoothing_width`).
+        - *neuron_group_name.spike_counts_0_001* (if `per_neuron` is `True`): The number of spikes of each neuron in
+          each bin, as a (bins x neurons) matrix. The indices of the neurons are stored in the PROPERTY
+          *neuron_group_name.spike_counts_0_001_neuron_indices*.
+
+        The number of neurons in a group is the number of its spike variables. Spike times that were flushed to the
+        file before are not counted.
+
+        Parameters
+        ----------
+        bin_widths : float or iterable of floats
+            The bin widths, in the unit of the spike times.
+        smoothing_width : float, optional
+            If not `None`, smooth the population rates with a Gaussian kernel with this standard deviation (in the
+            unit of the spike times). If `None` (default), do not smooth them.
+        per_neuron : boolean, optional
+            If `True` (default), also add the spike counts of the single neurons.
+
+        Returns
+        -------
+        BrianRecordingCreator
+            The creator itself, to allow chained method calls.
+
+        """
+        self._assert_not_created()
+        for bin_width in make_iterable(bin_widths):
+            if not bin_width > 0:
+                raise ValueError("Bin width must be larger than 0, is: " + str(bin_width))
+            self.population_activity_options[bin_width] = (smoothing_width, per_neuron)
+        return self
+
+    def record_model(self, model_filename, as_matrix=False, include=None, exclude=None, neurons=None, timestep=1,
+                     parameters=None):
         """Execute a Brian simulation, record all variables and add their values to the recording.
 
         The model file is responsible for running the simulation (by calling Brian's `run` or `Network.run` methods
@@ -206,16 +396,35 @@ class BrianRecordingCreator(RecordingCreator):
         ----------
         model_filename : string
             The path to the Python file for the Brian simulation.
+        as_matrix : boolean, optional
+            If `True`, store the state variables of each neuron group as one matrix per variable instead of one
+            variable per neuron (see `add_state_monitor`).
+        include : string or iterable of strings, optional
+            Shell-style wildcard patterns (see `fnmatch`) for the variables to record, given as
+            *neuron_group_name.variable* (use *spikes* as the variable for spike times), for example ``P.v`` or
+            ``*.spikes``. If `None` (default), all variables will be recorded. Neuron groups without any selected
+            variable are not monitored at all.
+        exclude : string or iterable of strings, optional
+            Wildcard patterns for variables that should not be recorded. Takes precedence over `include`.
+        neurons : int or iterable of ints, optional
+            Indices of the neurons to record in each neuron group (for example ``range(100)``). If an int, record a
+            random sample of this many neurons in each group (the sample is the same every time). If `None`
+            (default), record all neurons.
+        timestep : int, optional
+            Record the state variables only every `timestep` simulation steps (default: 1, every step).
+            Spike times are always recorded exactly.
+        parameters : dict, optional
+            Model parameters to change, as names and Python expressions, for example ``{'taum': '10 * ms'}``. Each
+            name must be assigned at the top level of the model file, which then assigns the expression instead
+            (see `utils.run_as_script`).
 
         Notes
         -----
         Known limitations:
 
-        - May conflict with debuggers because it uses `sys.settrace`.
-        - May not work with exotic Python distributions, use the official CPython version.
         - May not work with custom update algorithms, call Brian's `run` or `Network.run` methods somewhere.
-        - Cannot recognize simulation runs that are invoked in external Python scripts, which are executed from the
-          model file via the `runpy` module (use `execfile` or `import` instead).
+        - Neuron groups are named after the variables they are assigned to in the model file (or in the function
+          that created them). Groups without such a variable are named like *NeuronGroup123456*.
 
         """
         self._assert_not_created()
@@ -223,84 +432,181 @@ class BrianRecordingCreator(RecordingCreator):
 
         model_abspath = os.path.abspath(model_filename)
 
+        if not timestep >= 1:
+            raise ValueError("Recording timestep must be at least 1, is: " + str(timestep))
+
+        def is_selected(variable_name):
+            """Return `True` if the variable should be recorded according to `include` and `exclude`."""
+            if include is not None and not utils.matches_any(variable_name, include):
+                return False
+            if exclude is not None and utils.matches_any(variable_name, exclude):
+                return False
+            return True
+
+        def select_neurons(group):
+            """Return the indices of the neurons to record in a neuron group, or `True` for all neurons."""
+            if neurons is None:
+                return True
+            elif isinstance(neurons, int):
+                if neurons >= len(group):
+                    return True
+                return sorted(np.random.RandomState(0).choice(len(group), neurons, replace=False))
+            return [index for index in neurons if index < len(group)]
+
         # All these use the same indices. The elements are sorted in creation order of the NeuronGroups
         # (this is needed to handle duplicates).
         neuron_groups = []
+        creation_frames = []  # frames in which the neuron groups were created, to look up their names
         neuron_group_names = []
+        recorded_neurons = []
         spike_monitors = []
         multi_state_monitors = []
+        monitored_networks = {}  # Network -> indices of the neuron groups whose monitors were added to it
 
-        def append_neuron_group(group, name):
-            """Append a neuron group, its name and None for its monitors to the lists above."""
+        def append_neuron_group(group, frame):
+            """Append a neuron group, its creation frame and None for its name and monitors to the lists above."""
             neuron_groups.append(group)
-            neuron_group_names.append(name)
+            creation_frames.append(frame)
+            neuron_group_names.append(None)
+            recorded_neurons.append(None)
             spike_monitors.append(None)
             multi_state_monitors.append(None)
 
-        # TODO: Tracing is also active during the update function in brian. Find out how this can be disabled.
-        def trace_model(frame, event, arg):
-            if frame.f_code.co_name == 'run' and event == 'call':  # possible call to Brian's `run` or `Network.run`
-                # print '\n-------------- Run ----------------'
-                # print 'File:', frame.f_code.co_filename
-                # print 'Reached run function'
-                if 'self' in frame.f_locals:
-                    possible_network = frame.f_locals['self']
-                    # print '\tFound self:', possible_network
-                    try:
-                        groups = possible_network.groups
-                    except AttributeError:
-                        # print '\tIs no network'
-                        pass  # not a Network
-                    else:
-                        # print '\tIs network'
-                        for group in groups:
-                            try:
-                                index = neuron_groups.index(group)
-                            except ValueError:  # `group` is not in `neuron_groups`
-                                name = 'NeuronGroup' + str(id(group))
-                                append_neuron_group(group, name)
-                                index = -1
-
-                            # print '\tRecognized neuron group:', neuron_group_names[index]
-                            if not spike_monitors[index]:
-                                spike_monitors[index] = brian.SpikeMonitor(neuron_groups[index], record=True)
-                            if not multi_state_monitors[index]:
-                                multi_state_monitors[index] = brian.MultiStateMonitor(neuron_groups[index], record=True)
-                            possible_network.add(spike_monitors[index])
-                            possible_network.add(multi_state_monitors[index])
-                            # print '\tAdded its monitors'
-                        return  # do not trace during simulation run
-            elif os.path.abspath(frame.f_code.co_filename) == model_abspath:
-                # print '\n-------------- In Model ----------------'
-                # print 'File:', frame.f_code.co_filename
-                # Recognize all NeuronGroup's created in the model file or in a file that is run from the model file
-                # via execfile or import (not via runpy!).
-                for name, possible_neuron_group in frame.f_locals.iteritems():
-                    if isinstance(possible_neuron_group, brian.NeuronGroup) and possible_neuron_group not in neuron_groups:
-                        try:
-                            index = neuron_group_names.index(name)
-                        except ValueError:
-                            pass
-                        else:  # name is already occupied by another neuron group
-                            neuron_group_names[index] += id(neuron_group)
-                            name += id(possible_neuron_group)
-                        append_neuron_group(possible_neuron_group, name)
-                return trace_model
-            # elif event == 'call' and frame.f_code.co_filename == 'update':
-            #     print '\n-------------- Update ----------------'
-            #     print frame.f_code.co_filename
+        def name_neuron_group(index):
+            """Set the name of a neuron group to the name of the variable it was assigned to."""
+            group = neuron_groups[index]
+            frame = creation_frames[index]
+            namespace = {} if frame is None else frame.f_locals
+            name = next((name for name, value in namespace.iteritems() if value is group),
+                        'NeuronGroup' + str(id(group)))
+            if name in neuron_group_names:  # name is already occupied by another neuron group
+                name += str(id(group))
+            neuron_group_names[index] = name
+
+        # Instead of tracing all function calls, intercept the creation of neuron groups and all simulation runs.
+        original_neuron_group_init = brian.NeuronGroup.__dict__['__init__']
+        original_network_run = brian.Network.__dict__['run']
+
+        def neuron_group_init(group, *args, **kwargs):
+            # Brian looks up the namespace of the equations `level` frames above its constructor, skip this one.
+            if len(args) > 6:  # level was passed as positional argument
+                args = args[:6] + (args[6] + 1,) + args[7:]
             else:
-                # print '\n-------------- End Tracing ----------------'
-                # print frame.f_code.co_filename
-                return  # do not trace outside the scope of the model file
-
-        sys.settrace(trace_model)
-        utils.run_as_script(model_abspath)
-        sys.settrace(None)
+                kwargs['level'] = kwargs.get('level', 0) + 1
+            original_neuron_group_init(group, *args, **kwargs)
+            frame = sys._getframe(1)
+            while frame is not None and frame.f_globals.get('__name__', '').startswith('brian'):
+                frame = frame.f_back  # skip constructors of subclasses in brian
+            append_neuron_group(group, frame)
+
+        def network_run(network, *args, **kwargs):
+            # Brian's `run` function also calls this for a MagicNetwork.
+            monitored_indices = monitored_networks.setdefault(network, set())
+            for group in network.groups:
+                try:
+                    index = next(i for i, g in enumerate(neuron_groups) if g is group)
+                except StopIteration:  # created before the model file was run
+                    append_neuron_group(group, None)
+                    index = len(neuron_groups) - 1
+                if index in monitored_indices:
+                    continue
+                if neuron_group_names[index] is None:  # first run of this group, create its monitors
+                    name_neuron_group(index)
+                    recorded_neurons[index] = select_neurons(group)
+                    if is_selected(neuron_group_names[index] + '.spikes'):
+                        spike_monitors[index] = brian.SpikeMonitor(group, record=True)
+                    variables = [variable for variable in group.var_index.keys() if isinstance(variable, str) and
+                                 is_selected(neuron_group_names[index] + '.' + variable)]
+                    if variables:
+                        multi_state_monitors[index] = brian.MultiStateMonitor(group, vars=variables,
+                                                                              record=recorded_neurons[index],
+                                                                              timestep=timestep)
+                for monitor in spike_monitors[index], multi_state_monitors[index]:
+                    if monitor:
+                        network.add(monitor)
+                monitored_indices.add(index)
+            return original_network_run(network, *args, **kwargs)
+
+        brian.NeuronGroup.__init__ = neuron_group_init
+        brian.Network.run = network_run
+        try:
+            utils.run_as_script(model_abspath, parameters)
+        finally:
+            brian.NeuronGroup.__init__ = original_neuron_group_init
+            brian.Network.run = original_network_run
+        del creation_frames[:]  # release the frames
 
         # Process all created monitors.
-        for neuron_group_name, neuron_group, spike_monitor, multi_state_monitor in zip(neuron_group_names, neuron_groups, spike_monitors, multi_state_monitors):
+        for neuron_group_name, neuron_group, neuron_indices, spike_monitor, multi_state_monitor in zip(neuron_group_names, neuron_groups, recorded_neurons, spike_monitors, multi_state_monitors):
             if spike_monitor:
-                self.add_spike_monitor(spike_monitor, neuron_group_name)
+                self.add_spike_monitor(spike_monitor, neuron_group_name, None if neuron_indices is True else neuron_indices)
             if multi_state_monitor:
-                self.add_multi_state_monitor(multi_state_monitor, neuron_group_name)
+                self.add_multi_state_monitor(multi_state_monitor, neuron_group_name, as_matrix)
+
+    def _add_population_activity(self, bin_width, smoothing_width, per_neuron):
+        """Add the spike counts and firing rates for one bin width (see `add_population_activity`)."""
+        spike_variables = {}  # neuron group name -> (neuron index, variable name) for each of its spike variables
+        for name in self.values:
+            match = re.match(r'(?:(.*)\.)?[^.]*?(\d+)\.spikes$', name)  # like group.Neuron12.spikes
+            if match is not None and self.meta_types[name] == MetaType.EVENT:
+                spike_variables.setdefault(match.group(1) or '', []).append((int(match.group(2)), name))
+        if not spike_variables:
+            return
+
+        end_time = 0
+        for neurons in spike_variables.itervalues():
+            for neuron_index, name in neurons:
+                if len(self.values[name]):
+                    end_time = max(end_time, np.max(self.values[name]))
+        if self.time_points is not None and len(self.time_points):
+            end_time = max(end_time, self.time_points[-1])
+        num_bins = int(np.floor(end_time / bin_width)) + 1
+        time_unit = self.units[spike_variables.values()[0][0][1]]
+        suffix = str(bin_width).replace('.', '_')
+        time_axis = 'time_bins_' + suffix
+        self.add_time_points(np.arange(num_bins) * bin_width, time_unit, time_axis)
+
+        for neuron_group_name, neurons in spike_variables.iteritems():
+            neurons.sort()
+            spike_times = [np.asarray(self.values[name], dtype=float) for neuron_index, name in neurons]
+            columns = np.repeat(np.arange(len(neurons)), [len(times) for times in spike_times])
+            bins = np.floor(np.concatenate(spike_times) / bin_width).astype(int)
+            counts = np.bincount(bins * len(neurons) + columns, minlength=num_bins * len(neurons))
+            counts = counts.reshape(num_bins, len(neurons))
+
+            prefix = neuron_group_name + '.' if neuron_group_name else ''
+            if per_neuron:
+                self.add_values(prefix + 'spike_counts_' + suffix, counts, '', MetaType.STATE_VARIABLE,
+                                time_axis=time_axis)
+                self.add_values(prefix + 'spike_counts_' + suffix + '_neuron_indices',
+                                np.array([neuron_index for neuron_index, name in neurons]), '', MetaType.PROPERTY)
+            population_counts = counts.sum(axis=1)
+            self.add_values(prefix + 'population_spike_counts_' + suffix, population_counts, '',
+                            MetaType.STATE_VARIABLE, time_axis=time_axis)
+            rates = population_counts / float(len(neurons) * bin_width)
+            if smoothing_width:
+                sigma = smoothing_width / float(bin_width)  # in bins
+                half_width = min(int(np.ceil(3 * sigma)), (num_bins - 1) // 2)  # kernel not longer than rates
+                kernel = np.exp(-np.arange(-half_width, half_width + 1) ** 2 / (2 * sigma ** 2))
+                rates = np.convolve(rates, kernel / kernel.sum(), 'same')
+            self.add_values(prefix + 'population_rate_' + suffix, rates, '1/' + time_unit, MetaType.STATE_VARIABLE,
+                            time_axis=time_axis)
+
+    def _process_added_data(self, f):
+        """Compute the spike counts and firing rates (see `add_population_activity`) and write all data to file.
+
+        They are added to copies of the added data, so a failed write can be retried.
+
+        """
+        attribute_names = ('values', 'units', 'meta_types', 'custom_metadata', 'variable_time_axes', 'time_axes',
+                           'time_axis_units')
+        added_data = [getattr(self, attribute_name) for attribute_name in attribute_names]
+        for attribute_name, data in zip(attribute_names, added_data):
+            setattr(self, attribute_name, dict(data))
+        try:
+            for bin_width, (smoothing_width, per_neuron) in sorted(self.population_activity_options.iteritems()):
+                self._add_population_activity(bin_width, smoothing_width, per_neuron)
+            RecordingCreator._process_added_data(self, f)
+        finally:
+            for attribute_name, data in zip(attribute_names, added_data):
+                setattr(self, attribute_name, data)
@@ -1,5 +1,8 @@
 from __future__ import absolute_import
 import os
+import tempfile
+import time
+import h5py
 import numpy as np
 from org.geppetto.recording.creators.base import RecordingCreator, MetaType
 from org.geppetto.recording.creators import utils
@@ -19,6 +22,49 @@ def _assert_neuron_imported():
         raise ImportError("Could not import neuron, install it to proceed (see README for instructions)")
 
 
+def _vector_to_array(vector):
+    """Return the values of a NEURON vector as a NumPy array that shares the memory of the vector if possible."""
+    try:
+        return vector.as_numpy()
+    except AttributeError:  # older NEURON versions, copies the values via the buffer interface
+        return np.array(vector)
+
+
+def _segment_name(segment, section_name=None):
+    """Return the hierarchical name of a segment as used by `NeuronRecordingCreator.record_model`."""
+    section = segment.sec
+    if section_name is None:
+        section_name = section.name()
+    index = min(int(segment.x * section.nseg), section.nseg - 1)  # segments at the ends belong to the next segment
+    return section_name + '.segment' + str(index)
+
+
+def _point_process_type_names(model_h):
+    """Return the names of all point process types (like IClamp or ExpSyn)."""
+    point_process_types = model_h.MechanismType(1)
+    point_process_type = model_h.ref('')
+    type_names = []
+    for i in range(int(point_process_types.count())):
+        point_process_types.select(i)
+        point_process_types.selected(point_process_type)
+        type_names.append(point_process_type[0])
+    return type_names
+
+
+def _shard_filename(filename, rank):
+    """Return the path of the file to which one rank writes its part of a distributed recording."""
+    root, ext = os.path.splitext(filename)
+    return '{0}.rank{1}{2}'.format(root, rank, ext)
+
+
+def _record_model_to_file(filename, model_filename, kwargs):
+    """Record a NEURON model into a new recording file and return the statistics (called in an isolated process)."""
+    creator = NeuronRecordingCreator(filename, overwrite=True)
+    creator.record_model(model_filename, **kwargs)
+    creator.create()
+    return creator.statistics
+
+
 class NeuronRecordingCreator(RecordingCreator):
     """
     A RecordingCreator which interfaces to the NEURON simulator (www.neuron.yale.edu).
@@ -31,7 +77,7 @@ class NeuronRecordingCreator(RecordingCreator):
        The creator will read it and add all values to the recording (see `add_text_recording` and
        `add_binary_recording`).
     3. Use the creator inside a NEURON simulation (in Python) and add values from a NEURON vector with
-       *Vector.to_python()* and `add_values` or `add_time_points`.
+       *Vector.as_numpy()* and `add_values` or `add_time_points`.
 
     Some methods need to import the neuron package (see README for install instructions).
 
@@ -46,6 +92,9 @@ class NeuronRecordingCreator(RecordingCreator):
 
     def __init__(self, filename, overwrite=False):
         RecordingCreator.__init__(self, filename, 'NEURON', overwrite)
+        self.statistics = {}
+        self.parallel_context = None
+        self.distributed_filename = None
 
     @staticmethod
     def _replace_location_indices(s):
@@ -60,7 +109,8 @@ class NeuronRecordingCreator(RecordingCreator):
             s = s[:point_before_left_bracket] + 'segmentAt' + location_string.replace('.', '_') + '.' + s[point_before_left_bracket:left_bracket] + s[right_bracket+1:]
         return s
 
-    def add_text_recording(self, recording_file, variable_names=None, variable_units=None, time_column=True):
+    def add_text_recording(self, recording_file, variable_names=None, variable_units=None, time_column=True,
+                           cache=None):
         """Read a text recording file from the NEURON simulator and add its contents to the recording.
 
         The recording file has to be in text format. A range of file structures can be parsed. The data and variable
@@ -93,6 +143,8 @@ class NeuronRecordingCreator(RecordingCreator):
         time_column : int or boolean
             The zero-count index of the data column in the recording file that contains time points.
             If `True` (default), the first variable whose name contains *time* is the time column.
+        cache : utils.ParseCache, optional
+            If given, keep the parsed data in this cache, so adding the same file again does not parse it again.
 
         Returns
         -------
@@ -209,21 +261,28 @@ class NeuronRecordingCreator(RecordingCreator):
                         variable_units[i] = 'ms'
                     break
 
-        # Allocate arrays for data points.
-        num_total_data_lines = len(lines) - first_data_line
-        data_columns = np.zeros((num_data_columns, num_total_data_lines))
-
-        # Read all data and store it in the arrays.
-        for current_line, line in enumerate(lines[first_data_line:]):
-            text_items = utils.split_by_separators(line)
-            try:
-                numbers = map(float, text_items)
-            except ValueError:
-                raise TypeError("Could not cast to float: " + text_items)
-            try:
-                data_columns[:, current_line] = numbers
-            except ValueError:
-                raise IndexError("Encountered line with {0} number(s) for {1} variable(s): ".format(len(numbers), num_data_columns) + line)
+        def parse_data_lines():
+            # Allocate arrays for data points.
+            num_total_data_lines = len(lines) - first_data_line
+            data_columns = np.zeros((num_data_columns, num_total_data_lines))
+
+            # Read all data and store it in the arrays.
+            for current_line, line in enumerate(lines[first_data_line:]):
+                text_items = utils.split_by_separators(line)
+                try:
+                    numbers = map(float, text_items)
+                except ValueError:
+                    raise TypeError("Could not cast to float: " + text_items)
+                try:
+                    data_columns[:, current_line] = numbers
+                except ValueError:
+                    raise IndexError("Encountered line with {0} number(s) for {1} variable(s): ".format(len(numbers), num_data_columns) + line)
+            return data_columns
+
+        if cache is None:
+            data_columns = parse_data_lines()
+        else:
+            data_columns = cache.get(recording_file, parse_data_lines, (first_data_line, num_data_columns))
 
         # Add everything to the RecordingCreator.
         for current_line, (name, unit, data) in enumerate(zip(variable_names, variable_units, data_columns)):
@@ -271,21 +330,26 @@ class NeuronRecordingCreator(RecordingCreator):
         vector.vread(f)
         if vector:
             if is_time:
-                self.add_time_points(vector.to_python(), variable_unit)
+                self.add_time_points(_vector_to_array(vector), variable_unit)
             else:
-                self.add_values(variable_name, vector.to_python(), variable_unit, MetaType.STATE_VARIABLE)
+                self.add_values(variable_name, _vector_to_array(vector), variable_unit, MetaType.STATE_VARIABLE)
         else:
             raise IOError("Binary file could not be parsed or is empty: " + recording_file)
         return self
 
-    def record_model(self, model_filename, tstop=None, dt=None, format=None):
+    def record_model(self, model_filename, tstop=None, dt=None, format=None, include=None, exclude=None,
+                     sections=None, mechanisms=None, constant_tolerance=None, flush_interval=None,
+                     record_intervals=None, record_spikes=True, cvode=None, resample_time_step=None, isolated=False,
+                     distributed=False, parameters=None):
         """Execute a NEURON simulation, try to record all variables and add their values to the recording.
 
         The model file can be in Hoc or Python. Set `format` to force one; otherwise the file extension will be
         used. The model file must not start the simulation run. Instead, this method will load the model file
         and then run the simulation for `tstop` milliseconds (using the `neuron.run` command from Python).
-        All available variables for all sections, segments and mechanisms will be recorded and added to the recording
-        creator in hierarchical order (e. g. as *section.segment.mechanism.variable*).
+        All available variables for all sections, segments, mechanisms and point processes will be recorded and added
+        to the recording creator in hierarchical order (e. g. as *section.segment.mechanism.variable* or
+        *section.segment.IClamp[0].i*). Point processes without a location (like NetStim) are stored by their
+        name only. Spike times of all spike sources of NetCons are stored as events (see `record_spikes`).
 
         Parameters
         ----------
@@ -296,68 +360,360 @@ class NeuronRecordingCreator(RecordingCreator):
             Hoc file will be used, or 5 ms if it is not defined.
         dt : float, optional
             The time step to use for the simulation run (in ms). If `None` (default), the value ot the dt variable in
-            your Hoc file will be used (this is 0.025 ms by default).
+            your Hoc file will be used (this is 0.025 ms by default). Not used if `cvode` is active.
         format : 'hoc', 'py' or None, optional
             The format of the model file. If `None` (default), use the file extension.
+        include : string or iterable of strings, optional
+            Shell-style wildcard patterns (see `utils.matches_any`) for the hierarchical names of the variables to
+            record, for example ``soma.*.v``, ``*.hh.m`` or ``dend[0].*.v``. Only * and ? are wildcards, square
+            brackets match themselves. If `None` (default), all variables will be recorded.
+        exclude : string or iterable of strings, optional
+            Wildcard patterns for the hierarchical names of variables that should not be recorded. Takes precedence
+            over `include`.
+        sections : string or iterable of strings, optional
+            Names (or wildcard patterns) of the sections to record. If `None` (default), all sections will be
+            recorded, for example ``dend[0]`` or ``dend[*]``.
+        mechanisms : string or iterable of strings, optional
+            Names (or wildcard patterns) of the mechanisms and point processes to record (for example *hh*,
+            *na_ion* or *ExpSyn*). If `None` (default), all mechanisms will be recorded.
+        constant_tolerance : float, optional
+            If not `None`, variables whose recorded values vary by at most this amount during the simulation run will
+            be added as a single PROPERTY value instead of a STATE_VARIABLE. Use 0 to only store exactly constant
+            variables as properties. If `None` (default), all recorded variables are added as state variables.
+        flush_interval : float, optional
+            If not `None`, run the simulation in windows of this many milliseconds. After each window, the recorded
+            values are written to the recording file (see `flush`) and NEURON's recording vectors are emptied, so
+            memory consumption does not grow with `tstop`. Time points and values are the same as for a single run.
+            Cannot be combined with `constant_tolerance`.
+        record_intervals : dict or iterable of (string, float) tuples, optional
+            Recording intervals (in ms) for variables whose names match a wildcard pattern (as in `include`), for
+            example ``[('*.v', 0.1), ('dend[0].*.v', 1)]``. The first matching pattern is used (use a list to control the order).
+            Variables with a recording interval are stored with an additional time axis for each interval, like
+            *time_0_1ms*. If `None` (default) or if no pattern matches, variables are recorded at every time step.
+        record_spikes : boolean, optional
+            If `True` (default), record the threshold crossings of the spike source of each NetCon in the model
+            (a segment's voltage or a point process like NetStim) and add their times as an EVENT variable named
+            like *section.segment.spikes* or *NetStim[0].spikes*. These are selected by `include`, `exclude`
+            and `sections` as well.
+        cvode : boolean, optional
+            If `True`, run the simulation with variable time steps (CVode), if `False`, with the fixed time step `dt`.
+            If `None` (default), use the setting of the model file. With CVode, the time points of the recording are
+            the adaptive time points of the simulation, unless `resample_time_step` is given.
+        resample_time_step : float, optional
+            If not `None`, resample all state variables onto time points from 0 to the last recorded time point with
+            this time step (in ms) by linear interpolation, after the simulation run. Useful with `cvode`, to get a uniform time axis.
+            Variables with a recording interval (see `record_intervals`) are not resampled. Cannot be combined with
+            `flush_interval`.
+        isolated : boolean, optional
+            If `True`, load and run the model in a fresh Python interpreter (see `utils.run_isolated`), which records
+            into a temporary file whose contents are then added to this creator. The sections and settings of the
+            model do not leak into this process, so several models can be recorded one after another (also from
+            parallel threads). If `False` (default), run the model in this process.
+        distributed : boolean or iterable of ints, optional
+            If `True`, the model is a network that is distributed with NEURON's ParallelContext (run this method on
+            all ranks, for example with ``mpiexec -n 4 python script.py``). Each rank records its own cells and the
+            simulation is run with ``ParallelContext.psolve``. Sections of a cell (or an artificial cell) that was
+            registered with ``ParallelContext.cell`` are named by its gid, like *gid12.soma.segment0.v*, all other
+            names are prefixed by the rank, like *rank0.NetStim[0].spikes* (the filters apply to these names).
+            Spike times of cells with a gid are named like *gid12.spikes*.
+            The gids are found through the NetCons of the model; if the model does not keep the NetCons that
+            register its cells, pass the gids (of all cells, on all ranks) instead of `True`.
+            If there are several ranks, each one writes to its own file (see `flush`) and `create` merges these into
+            the recording file on rank 0; `create` has to be called on all ranks then.
+        parameters : dict, optional
+            Model parameters to change, as names and Python expressions, for example ``{'num_cells': '20'}``. Each
+            name must be assigned at the top level of the model file, which then assigns the expression instead
+            (see `utils.run_as_script`). Only for Python model files.
+
+        Returns
+        -------
+        NeuronRecordingCreator
+            The creator itself, to allow chained method calls.
+
+        Notes
+        -----
+        Variables that are not selected by `include`, `exclude`, `sections` and `mechanisms` will not get a recording
+        vector in NEURON at all, so filtering also speeds up the simulation run.
+
+        After the run, some figures about the recording are stored in the `statistics` dictionary of the creator
+        (for example *setup_time* in seconds, or *constant_variables* and *saved_values* if `constant_tolerance`
+        is set).
 
         """
-        # TODO: Calling this method multiple times with hoc models could populate allsec with all sections from all models. Investigate this and possibly find a workaround.
+        # TODO: Calling this method multiple times with hoc models could populate allsec with all sections from all models. Use `isolated` as a workaround.
 
         self._assert_not_created()
         _assert_neuron_imported()
 
+        if isolated:
+            kwargs = dict(tstop=tstop, dt=dt, format=format, include=include, exclude=exclude, sections=sections,
+                          mechanisms=mechanisms, constant_tolerance=constant_tolerance, flush_interval=flush_interval,
+                          record_intervals=record_intervals, record_spikes=record_spikes, cvode=cvode,
+                          resample_time_step=resample_time_step, distributed=distributed, parameters=parameters)
+            fd, temp_filename = tempfile.mkstemp(suffix='.h5')
+            os.close(fd)
+            try:
+                statistics = utils.run_isolated(_record_model_to_file, temp_filename,
+                                                os.path.abspath(model_filename), kwargs)
+                self._add_recording_file(temp_filename)
+            finally:
+                os.remove(temp_filename)
+            self.statistics.update(statistics)
+            return self
+
+        if flush_interval is not None:
+            if not flush_interval > 0:
+                raise ValueError("Flush interval must be larger than 0, is: " + str(flush_interval))
+            if constant_tolerance is not None:
+                raise ValueError("Constant variables cannot be detected if the values are flushed in between")
+            if resample_time_step is not None:
+                raise ValueError("Values cannot be resampled if they are flushed in between")
+        if resample_time_step is not None and not resample_time_step > 0:
+            raise ValueError("Resample time step must be larger than 0, is: " + str(resample_time_step))
+
+        if isinstance(record_intervals, dict):
+            record_intervals = record_intervals.items()
+        for pattern, interval in record_intervals or []:
+            if not interval > 0:
+                raise ValueError("Recording interval must be larger than 0, is: " + str(interval))
+
         if format is None:
             format = os.path.splitext(model_filename)[1][1:]
 
         # Execute the model file (hoc or py) and get the neuron.h object.
         if format == 'py':
-            vars_dict = utils.run_as_script(model_filename)
+            vars_dict = utils.run_as_script(model_filename, parameters)
             try:
                 model_h = vars_dict['h']
             except KeyError:
                 raise RuntimeError("Could not find neuron.h in the model file")
         elif format == 'hoc':
+            if parameters:
+                raise ValueError("Parameters can only be changed in Python model files")
             h.load_file(os.path.abspath(model_filename).replace('\\', '/'))  # needs slashes, also on Windows
             model_h = h
         else:
             raise ValueError("Invalid file format, must be hoc or py")
 
+        # Gids of the cells and artificial cells on this rank by their names (distributed mode), like Cell[0] -> 12.
+        cell_gids = {}
+        if distributed:
+            if self.parallel_context is None:
+                self.parallel_context = model_h.ParallelContext()
+                num_ranks = int(self.parallel_context.nhost())
+                if num_ranks > 1:  # record into a separate file on each rank, see `create`
+                    self.distributed_filename = self.filename
+                    self.filename = _shard_filename(self.filename, int(self.parallel_context.id()))
+            rank_prefix = 'rank{0}.'.format(int(self.parallel_context.id()))
+            # NEURON cannot list the gids of a rank, so try the gids that NetCons refer to and the ones given.
+            gids = set(int(netcon.srcgid()) for netcon in model_h.List('NetCon'))
+            if distributed is not True:
+                gids.update(distributed)
+            for gid in gids:
+                if gid >= 0 and self.parallel_context.gid_exists(gid):
+                    cell = self.parallel_context.gid2cell(gid)  # None for sections that are not part of a cell
+                    if cell is not None:
+                        cell_gids[cell.hname() if hasattr(cell, 'hname') else str(cell)] = gid
+
+        def cell_of(section):
+            """Return the name and gid of the cell with a gid that a section belongs to, or `None` (distributed mode)."""
+            cell = section.cell()
+            if cell is not None:
+                cell_name = cell.hname() if hasattr(cell, 'hname') else str(cell)
+                if cell_name in cell_gids and section.name().startswith(cell_name):
+                    return cell_name, cell_gids[cell_name]
+            return None
+
+        def section_name(section):
+            """Return the name of a section in the recording."""
+            name = section.name()
+            if not distributed:
+                return name
+            cell = cell_of(section)
+            if cell is not None:
+                cell_name, gid = cell
+                return 'gid{0}{1}'.format(gid, name[len(cell_name):])
+            return rank_prefix + name
+
+        # Point processes in cells with a gid are numbered per cell and type (like gid1.soma.segment0.ExpSyn[0]),
+        # because their global numbers (like ExpSyn[3]) depend on the number of ranks. Maps global to local names.
+        cell_point_process_names = {}
+        if cell_gids:
+            num_cell_point_processes = {}
+            for type_name in _point_process_type_names(model_h):
+                for point_process in model_h.List(type_name):
+                    cell = cell_of(point_process.get_segment().sec) if point_process.has_loc() else None
+                    if cell is not None:
+                        index = num_cell_point_processes.get((cell, type_name), 0)
+                        num_cell_point_processes[(cell, type_name)] = index + 1
+                        cell_point_process_names[point_process.hname()] = '{0}[{1}]'.format(type_name, index)
+
+        def located_point_process_name(point_process, segment_name):
+            """Return the name of a point process with a location in the recording."""
+            hname = point_process.hname()
+            return segment_name + '.' + cell_point_process_names.get(hname, hname)
+
+        def object_name(hoc_obj):
+            """Return the name of a point process without a location in the recording."""
+            name = hoc_obj.hname()
+            if not distributed:
+                return name
+            elif name in cell_gids:
+                return 'gid{0}'.format(cell_gids[name])
+            return rank_prefix + name
+
         # Record time.
         time_vector = h.Vector()
         time_vector.record(h._ref_t)
         vectors = {}
-
-        def add_vectors_for_variables(hoc_obj, hoc_obj_name, ignore=None):
-            """Add a recording vector to `vectors` for each recordable variable of a NEURON object."""
+        time_vectors = {}
+        variable_time_axes = {}
+
+        def time_axis_for_interval(interval):
+            """Return the name of the time axis for a recording interval and record the time at this interval."""
+            time_axis = 'time_{0}ms'.format(interval).replace('.', '_')
+            if time_axis not in time_vectors:
+                time_vectors[time_axis] = h.Vector()
+                time_vectors[time_axis].record(h._ref_t, interval)
+            return time_axis
+
+        def is_selected(variable_name):
+            """Return `True` if the variable should be recorded according to `include` and `exclude`."""
+            if include is not None and not utils.matches_any(variable_name, include):
+                return False
+            if exclude is not None and utils.matches_any(variable_name, exclude):
+                return False
+            return True
+
+        # Names of the recordable attributes for each kind of object (section, segment with a certain set of
+        # mechanisms or mechanism type). These are the same for all objects of a kind, so look them up only once.
+        recordable_attributes = {}
+
+        def get_recordable_attributes(hoc_obj, kind, ignore=None):
+            """Return the names of all attributes of a NEURON object that can be recorded (cached by `kind`)."""
+            try:
+                return recordable_attributes[kind]
+            except KeyError:
+                pass
             if ignore is None:
                 ignore = []
+            attrs = []
             for attr in dir(hoc_obj):
                 if not attr.startswith('__') and attr not in ignore:
                     try:
-                        ref = getattr(segment, '_ref_' + attr)
-                    except (NameError, AttributeError):
+                        getattr(hoc_obj, '_ref_' + attr)
+                    except (NameError, AttributeError, TypeError):  # TypeError for methods of point processes
                         pass
                     else:
-                        vec = model_h.Vector()
-                        vec.record(ref)
-                        vectors[hoc_obj_name + '.' + attr] = vec
-                        # TODO: Get the unit of the attr.
+                        attrs.append(attr)
+            recordable_attributes[kind] = attrs
+            return attrs
+
+        def add_vectors_for_variables(hoc_obj, hoc_obj_name, kind, ignore=None):
+            """Add a recording vector to `vectors` for each selected and recordable variable of a NEURON object."""
+            for attr in get_recordable_attributes(hoc_obj, kind, ignore):
+                variable_name = hoc_obj_name + '.' + attr
+                if not is_selected(variable_name):
+                    continue
+                ref = getattr(hoc_obj, '_ref_' + attr)
+                vec = model_h.Vector()
+                for pattern, interval in record_intervals or []:
+                    if utils.matches_any(variable_name, pattern):
+                        vec.record(ref, interval)
+                        variable_time_axes[variable_name] = time_axis_for_interval(interval)
+                        break
+                else:
+                    vec.record(ref)
+                vectors[variable_name] = vec
+                # TODO: Get the unit of the attr.
 
-        # TODO: Find out which variables are static, add them as properties and do not record them in vectors.
+        # TODO: Find out which variables are static before the run and do not record them in vectors
+        # (for now, they can only be detected after the run, see `constant_tolerance`).
+        setup_start_time = time.time()
         for section in model_h.allsec():
-            self.add_values(section.name() + '.L', section.L, 'um', MetaType.PARAMETER)
+            name = section_name(section)
+            if sections is not None and not utils.matches_any(name, sections):
+                continue
+            self.add_values(name + '.L', section.L, 'um', MetaType.PARAMETER)
             # TODO: For Python models, section.name() gives ugly names. Instead, extract the name of the variable in the Python file (like in BrianRecordingCreator).
-            add_vectors_for_variables(section, section.name())
-            unformatted_segment_name = section.name() + '.segment{0}'
+            add_vectors_for_variables(section, name, 'section')
+            unformatted_segment_name = name + '.segment{0}'
             for i, segment in enumerate(section):
                 segment_name = unformatted_segment_name.format(i)
                 self.add_values(segment_name + '.x', segment.x, '', MetaType.PROPERTY)
-                add_vectors_for_variables(segment, segment_name)
+                segment_mechanisms = list(segment)
+                # The attributes of a segment depend on its mechanisms (like gnabar_hh or ena).
+                segment_kind = ('segment',) + tuple(mechanism.name() for mechanism in segment_mechanisms)
+                add_vectors_for_variables(segment, segment_name, segment_kind)
                 unformatted_mechanism_name = segment_name + '.{0}'
-                for mechanism in segment:
-                    add_vectors_for_variables(mechanism, unformatted_mechanism_name.format(mechanism.name()))
+                for mechanism in segment_mechanisms:
+                    if mechanisms is not None and not utils.matches_any(mechanism.name(), mechanisms):
+                        continue
+                    add_vectors_for_variables(mechanism, unformatted_mechanism_name.format(mechanism.name()),
+                                              ('mechanism', mechanism.name()))
+
+        # Point processes (like synapses, IClamps or NetStims) are not contained in the mechanisms of a segment.
+        for type_name in _point_process_type_names(model_h):
+            if mechanisms is not None and not utils.matches_any(type_name, mechanisms):
+                continue
+            for point_process in model_h.List(type_name):
+                if point_process.has_loc():
+                    segment = point_process.get_segment()
+                    name = section_name(segment.sec)
+                    if sections is not None and not utils.matches_any(name, sections):
+                        continue
+                    point_process_name = located_point_process_name(point_process, _segment_name(segment, name))
+                else:
+                    point_process_name = object_name(point_process)
+                # donotuse (e.g. in NetStim) points to a random number generator, recording it crashes NEURON.
+                add_vectors_for_variables(point_process, point_process_name, ('point_process', type_name),
+                                          ignore=['donotuse'])
+
+        # Record spike times through separate NetCons without a target, because each NetCon can only record to
+        # one vector (which might be used by the model itself). NetCons with the same source share one detector.
+        spike_vectors = {}
+        if record_spikes:
+            if distributed:
+                # The spikes of cells with a gid are recorded by the ParallelContext (their NetCons may be gone).
+                for gid in cell_gids.itervalues():
+                    name = 'gid{0}.spikes'.format(gid)
+                    if is_selected(name):
+                        vec = model_h.Vector()
+                        gid_vec = model_h.Vector()
+                        self.parallel_context.spike_record(gid, vec, gid_vec)
+                        spike_vectors[name] = (gid_vec, vec)
+            for netcon in model_h.List('NetCon'):
+                if distributed and netcon.srcgid() >= 0:  # see above
+                    continue
+                source_segment = netcon.preseg()
+                source = netcon.pre()
+                if source_segment is not None:
+                    name = section_name(source_segment.sec)
+                    if sections is not None and not utils.matches_any(name, sections):
+                        continue
+                    name = _segment_name(source_segment, name) + '.spikes'
+                elif source is not None:
+                    if source.has_loc():
+                        segment = source.get_segment()
+                        name = located_point_process_name(source, _segment_name(segment, section_name(segment.sec)))
+                        name += '.spikes'
+                    else:
+                        name = object_name(source) + '.spikes'
+                else:  # NetCon without a source
+                    continue
+                if name in spike_vectors or not is_selected(name):
+                    continue
+                if source_segment is not None:
+                    detector = model_h.NetCon(source_segment._ref_v, None, sec=source_segment.sec)
+                else:
+                    detector = model_h.NetCon(source, None)
+                detector.threshold = netcon.threshold
+                vec = model_h.Vector()
+                detector.record(vec)
+                spike_vectors[name] = (detector, vec)
 
-        # TODO: Look at point processes.
+        self.statistics['setup_time'] = time.time() - setup_start_time
+        self.statistics['discovered_object_kinds'] = len(recordable_attributes)
 
         # Run the simulation
         if tstop is None:
@@ -369,12 +725,124 @@ class NeuronRecordingCreator(RecordingCreator):
         if dt is not None:
             model_h.dt = dt
 
+        if cvode is not None:
+            # Restored after the run, CVode also changes dt.
+            cvode_was_active = model_h.CVode().active()
+            fixed_dt = model_h.dt
+            model_h.CVode().active(int(cvode))
+
         #print 'Running for', tstop, 'ms with timestep', model_h.dt, 'ms'
 
-        neuron.init()
-        neuron.run(tstop)
+        if distributed:
+            # Spikes are exchanged between the ranks at least every 10 ms (or the minimum NetCon delay).
+            self.parallel_context.set_maxstep(10)
+            model_h.finitialize()
+            run = self.parallel_context.psolve
+        else:
+            neuron.init()
+            run = neuron.run
+        self.statistics['recorded_variables'] = len(vectors)
+        self.statistics['recorded_spike_sources'] = len(spike_vectors)
+
+        if flush_interval is not None:
+            # Move the values of each window to the file and empty the vectors, NEURON keeps appending to them.
+            window_end = 0
+            while True:
+                window_end = min(window_end + flush_interval, tstop)
+                run(window_end)
+                for name, vector in vectors.iteritems():
+                    self.add_values(name, _vector_to_array(vector), '', MetaType.STATE_VARIABLE,
+                                    time_axis=variable_time_axes.get(name))
+                    vector.resize(0)
+                self.add_time_points(_vector_to_array(time_vector), 'ms')
+                time_vector.resize(0)
+                for time_axis, vector in time_vectors.iteritems():
+                    self.add_time_points(_vector_to_array(vector), 'ms', time_axis)
+                    vector.resize(0)
+                for name, (detector, vector) in spike_vectors.iteritems():
+                    self.add_values(name, _vector_to_array(vector), 'ms', MetaType.EVENT)
+                    vector.resize(0)
+                self.flush()
+                if window_end >= tstop:
+                    break
+            if cvode is not None:
+                model_h.CVode().active(cvode_was_active)
+                model_h.dt = fixed_dt
+            for vector in vectors.values() + time_vectors.values():
+                vector.play_remove()
+            time_vector.play_remove()
+            return self
+
+        run(tstop)
+        if cvode is not None:
+            model_h.CVode().active(cvode_was_active)
+            model_h.dt = fixed_dt
+
+        time_points = _vector_to_array(time_vector)
+        if resample_time_step is not None:
+            # Time points from 0 to the end of the simulation run (with some tolerance for rounding errors).
+            num_resampled_time_points = int(np.floor(time_points[-1] / resample_time_step + 1e-9)) + 1
+            resampled_time_points = np.arange(num_resampled_time_points) * resample_time_step
+
+        num_constant = 0
+        num_saved_values = 0
+        num_saved_bytes = 0
+        # Hand the memory of each vector to the creator and release the vector right afterwards.
+        while vectors:
+            name, vector = vectors.popitem()
+            values = _vector_to_array(vector)
+            if resample_time_step is not None and name not in variable_time_axes:
+                values = np.interp(resampled_time_points, time_points, values)
+            if constant_tolerance is not None and len(values) and np.ptp(values) <= constant_tolerance:
+                self.add_values(name, values[0], '', MetaType.PROPERTY)
+                num_constant += 1
+                num_saved_values += len(values) - 1
+                num_saved_bytes += (len(values) - 1) * values.itemsize
+            else:
+                self.add_values(name, values, '', MetaType.STATE_VARIABLE, time_axis=variable_time_axes.get(name))
+            vector.play_remove()
+        if constant_tolerance is not None:
+            self.statistics['constant_variables'] = num_constant
+            self.statistics['saved_values'] = num_saved_values
+            self.statistics['saved_bytes'] = num_saved_bytes
+
+        if resample_time_step is not None:
+            self.add_time_points(resampled_time_points, 'ms')
+        else:
+            self.add_time_points(time_points, 'ms')
+        time_vector.play_remove()
+        for time_axis, vector in time_vectors.iteritems():
+            self.add_time_points(_vector_to_array(vector), 'ms', time_axis)
+            vector.play_remove()
+        while spike_vectors:
+            name, (detector, vector) = spike_vectors.popitem()
+            self.add_values(name, _vector_to_array(vector), 'ms', MetaType.EVENT)
+        return self
+
+    def create(self):
+        """Create the recording file and write all data to it.
 
-        for name, vector in vectors.iteritems():
-            self.add_values(name, vector.to_python(), '', MetaType.STATE_VARIABLE)
+        If `record_model` recorded a distributed model on several ranks, this has to be called on all ranks. Each
+        rank writes its part of the recording to a separate file, which rank 0 merges into the recording file.
 
-        self.add_time_points(time_vector.to_python(), 'ms')
+        """
+        RecordingCreator.create(self)
+        if self.distributed_filename is None:
+            return
+        self.parallel_context.barrier()  # wait until all ranks have written their files
+        if int(self.parallel_context.id()) == 0:
+            shard_filenames = [_shard_filename(self.distributed_filename, rank)
+                               for rank in range(int(self.parallel_context.nhost()))]
+            with h5py.File(self.distributed_filename, 'w') as f:
+                for shard_filename in shard_filenames:
+                    with h5py.File(shard_filename, 'r') as shard:
+                        for name, value in shard.attrs.iteritems():
+                            f.attrs[name] = value
+                        # Top level groups are gids or ranks, so they are unique. Time points are the same on all ranks.
+                        for name in shard:
+                            if name not in f:
+                                shard.copy(name, f)
+            for shard_filename in shard_filenames:
+                os.remove(shard_filename)
+        self.parallel_context.barrier()
+        self.filename = self.distributed_filename
@@ -0,0 +1,17 @@
+"""
+Small Brian model whose NeuronGroup is created in a function and run twice through an explicit Network.
+"""
+
+from brian import *
+
+
+def make_group():
+    tau = 20 * msecond
+    inputs = NeuronGroup(N=3, model='dV/dt = -V/tau : volt', threshold=-50 * mvolt, reset=-60 * mvolt)
+    inputs.V = -55 * mvolt
+    return inputs
+
+H = make_group()
+net = Network(H)
+net.run(0.01 * second)
+net.run(0.01 * second)
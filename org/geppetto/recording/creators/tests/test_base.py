@@ -1,4 +1,6 @@
 import unittest
+import h5py
+import numpy as np
 from org.geppetto.recording.creators import RecordingCreator, MetaType
 from org.geppetto.recording.creators.tests.abstest import AbstractTestCase
 
@@ -75,6 +77,59 @@ class RecordingCreatorTestCase(AbstractTestCase):
         self.assertEquals(c.units['a.var'], 'DimensionlessUnit')
         c.create()
 
+    def test_numpy_values(self):
+        c = RecordingCreator('test_numpy_values.h5', '', True)
+        self.register_recording_creator(c)
+        values = np.array([1.0, 2.0, 3.0])
+        c.add_values('a.var', values, 'mV', MetaType.STATE_VARIABLE)
+        values[0] = 0.0  # the creator keeps its own copy
+        c.add_values('a.var', np.array([4.0, 5.0]))
+        c.add_values('a.var', 6.0)
+        c.add_time_points(np.arange(6.0), 's')
+        self.assertEquals(list(c.values['a.var']), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        self.assertEquals(list(c.time_points), [0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+        c.create()
+
+    def test_flush(self):
+        c = RecordingCreator('test_flush.h5', '', True)
+        self.register_recording_creator(c)
+        c.add_values('a.var', [1, 2], 'mV', MetaType.STATE_VARIABLE)
+        c.add_values('a.prop', 7, 'mV', MetaType.PROPERTY)
+        c.add_time_points([0.1, 0.2], 's')
+        c.flush()
+        self.assertEquals(c.values['a.var'], [])
+        self.assertEquals(c.flushed_lengths['a.var'], 2)
+        c.add_values('a.var', np.array([3, 4]))
+        c.add_time_points(np.array([0.3, 0.4]))
+        c.flush()
+        c.add_values('a.var', 5)
+        c.add_time_points(0.5)
+        self.assertRaises(IndexError, c.add_values('a.var', 6).create)
+        c.add_time_points(0.6)
+        c.create()
+        with h5py.File(c.filename, 'r') as f:
+            self.assertEquals(list(f['a/var']), [1, 2, 3, 4, 5, 6])
+            self.assertEquals(list(f['a/prop']), [7])
+            self.assertAlmostEquals(list(f['time']), [0.1, 0.2, 0.3, 0.4, 0.5, 0.6])
+            self.assertEquals(f['a/var'].attrs['unit'], 'mV')
+
+    def test_time_axes(self):
+        c = RecordingCreator('test_time_axes.h5', '', True)
+        self.register_recording_creator(c)
+        c.add_values('a.fast', [1, 2, 3, 4], 'mV', MetaType.STATE_VARIABLE)
+        c.add_values('a.slow', [1, 3], 'mV', MetaType.STATE_VARIABLE, time_axis='time_2s')
+        self.assertRaises(ValueError, c.add_values, 'a.slow', [5], time_axis='time_3s')
+        c.set_time_step(1, 's')
+        self.assertRaises(RuntimeError, c.create)  # no time points for time_2s
+        c.add_time_points([0, 2], 's', 'time_2s')
+        self.assertRaises(ValueError, c.add_time_points, [4], 'ms', 'time_2s')
+        c.create()
+        with h5py.File(c.filename, 'r') as f:
+            self.assertEquals(list(f['time']), [0, 1, 2, 3])
+            self.assertEquals(list(f['time_2s']), [0, 2])
+            self.assertEquals(f['a/slow'].attrs['time_axis'], 'time_2s')
+            self.assertFalse('time_axis' in f['a/fast'].attrs)
+
 
 if __name__ == '__main__':
     unittest.main()  # automatically executes all methods above that start with 'test_'
@@ -1,6 +1,9 @@
 import unittest
 import os
 import sys
+import threading
+import time
+import h5py
 from org.geppetto.recording.creators import BrianRecordingCreator
 from org.geppetto.recording.creators.tests.abstest import AbstractTestCase
 
@@ -19,6 +22,85 @@ class BrianRecordingCreatorTestCase(AbstractTestCase):
         self.assertAlmostEquals(c.values['neuron4.spikes'], [0.0337])
         c.create()
 
+    def test_big_text_recording(self):
+        c = BrianRecordingCreator('test_big_text_recording.h5')
+        self.register_recording_creator(c)
+        c.add_recording(os.path.abspath('brian_recordings/filespikemonitor_big.dat'), 'group')
+        self.assertEqual(sum(len(values) for values in c.values.values()), 10000)
+        self.assertAlmostEquals(c.values['group.neuron3.spikes'][:4], [0.0014, 0.0493, 0.0014, 0.0493])  # file order
+        c.create()
+
+    def test_empty_text_recording(self):
+        c = BrianRecordingCreator('test_empty_text_recording.h5')
+        self.register_recording_creator(c)
+        c.add_recording(os.path.abspath('brian_recordings/filespikemonitor_empty.dat'))
+        self.assertEqual(c.values, {})
+        c.create()
+
+    def test_corrupted_text_recording(self):
+        c = BrianRecordingCreator('test_corrupted_text_recording.h5')  # never created
+        corrupted_filename = os.path.abspath('brian_recordings/filespikemonitor_corrupted.dat')
+        self.assertRaises(IOError, c.add_recording, corrupted_filename)
+        self.assertRaises(IOError, c.follow_recording, corrupted_filename, timeout=1)
+        self.assertEqual(c.values, {})  # the lines before the corrupted one are not added either
+
+    def test_population_activity(self):
+        c = BrianRecordingCreator('test_population_activity.h5')
+        self.register_recording_creator(c)
+        c.add_recording(os.path.abspath('brian_recordings/filespikemonitor.dat'), 'G')
+        c.add_population_activity([0.01, 0.05], smoothing_width=0.01)
+        c.create()
+        with h5py.File(c.filename, 'r') as f:
+            self.assertAlmostEquals(f['time_bins_0_05'][...], [0, 0.05])
+            self.assertAlmostEquals(f['G/population_spike_counts_0_05'][...], [6, 2])
+            self.assertAlmostEquals(f['G/population_rate_0_05'][...], [24, 8])  # 6 spikes / 5 neurons / 0.05
+            self.assertEqual(f['G/population_rate_0_05'].attrs['time_axis'], 'time_bins_0_05')
+            self.assertAlmostEquals(f['G/spike_counts_0_01'][1], [1, 0, 0, 0, 0])  # neuron 0 spiked at 0.0102
+            self.assertAlmostEquals(f['G/spike_counts_0_01_neuron_indices'][...], range(5))
+
+    def test_population_activity_after_failed_create(self):
+        c = BrianRecordingCreator('test_population_activity_after_failed_create.h5')
+        self.register_recording_creator(c)
+        c.add_recording(os.path.abspath('brian_recordings/filespikemonitor.dat'), 'G')
+        c.add_population_activity(0.05)
+        os.mkdir(c.filename)  # cannot be opened as a file
+        try:
+            self.assertRaises(IOError, c.create)
+        finally:
+            os.rmdir(c.filename)
+        c.create()  # retry
+        with h5py.File(c.filename, 'r') as f:
+            self.assertEqual(list(f['time_bins_0_05'][...]), [0, 0.05])  # added only once
+            self.assertEqual(list(f['G/population_spike_counts_0_05'][...]), [6, 2])
+
+    def test_follow_recording(self):
+        with open('brian_recordings/filespikemonitor.dat', 'r') as f:
+            lines = f.readlines()
+        growing_filename = 'test_follow_recording.dat'
+
+        def write_lines():
+            with open(growing_filename, 'w', 0) as f:  # unbuffered
+                for line in lines:
+                    f.write(line[:3])  # also write incomplete lines
+                    time.sleep(0.01)
+                    f.write(line[3:])
+                f.write('END\n')
+
+        c = BrianRecordingCreator('test_follow_recording.h5')
+        self.register_recording_creator(c)
+        writer = threading.Thread(target=write_lines)
+        writer.start()
+        try:
+            c.follow_recording(growing_filename, sentinel='END', timeout=10, poll_interval=0.005)
+        finally:
+            writer.join()
+            os.remove(growing_filename)
+        self.assertAlmostEquals(c.values['neuron0.spikes'], [0.0102, 0.0582])
+        self.assertAlmostEquals(c.values['neuron4.spikes'], [0.0337])
+        self.assertEqual(sum(len(values) for values in c.values.values()), len(lines))
+        self.assertRaises(ValueError, c.follow_recording, growing_filename)  # no stop condition
+        c.create()
+
     def test_binary_recording(self):
         c = BrianRecordingCreator('test_binary_recording.h5')
         self.register_recording_creator(c)
@@ -44,6 +126,56 @@ class BrianRecordingCreatorTestCase(AbstractTestCase):
         # TODO: Make model shorter and run assertEquals.
         c.create()
 
+    def test_model_as_matrix(self):
+        c = BrianRecordingCreator('test_model_as_matrix.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('brian_models/tutorial_model.py'), as_matrix=True)
+        self.assertEqual(c.values['G.V'].shape, (len(c.time_points), 5))
+        self.assertAlmostEquals(c.values['G.V_neuron_indices'], range(5))
+        first_values = list(c.values['G.V'][0, :4])  # one column per neuron, initial potentials increase with the index
+        self.assertEqual(first_values, sorted(first_values))
+        self.assertNotIn('G.Neuron0.V', c.values)
+        c.create()
+
+    def test_model_with_parameters(self):
+        c = BrianRecordingCreator('test_model_with_parameters.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('brian_models/tutorial_model.py'), parameters={'num_neurons': '3',
+                                                                                     'Vr': '-70 * mvolt'})
+        self.assertIn('G.Neuron2.V', c.values)
+        self.assertNotIn('G.Neuron3.V', c.values)
+        self.assertAlmostEquals(c.values['G.Neuron0.V'][0], -0.07, delta=0.002)  # starts at the reset value
+        c.create()
+
+        c = BrianRecordingCreator('test_model_with_parameters_2.h5')
+        self.assertRaises(ValueError, c.record_model, os.path.abspath('brian_models/tutorial_model.py'),
+                          parameters={'num_neuron': '3'})  # not assigned in the model file
+
+    def test_network_model(self):
+        c = BrianRecordingCreator('test_network_model.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('brian_models/network_model.py'))
+        self.assertIn('inputs.Neuron2.V', c.values)  # named after the variable in the function that created it
+        self.assertEqual(len(c.values['inputs.Neuron2.V']), len(c.time_points))  # monitored once for both runs
+        self.assertAlmostEquals(c.time_points[-1] - c.time_points[0], 0.0199)  # both runs
+        c.create()
+
+    def test_model_with_filters(self):
+        c = BrianRecordingCreator('test_model_with_filters.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('brian_models/tutorial_model.py'), include='G.*', exclude='*.spikes',
+                       neurons=[1, 3], timestep=10)
+        self.assertEqual(sorted(c.values), ['G.Neuron1.V', 'G.Neuron3.V'])
+        self.assertEqual(len(c.time_points), 100)  # 0.1 s with a time step of 0.1 ms, every 10th step
+        self.assertEqual(len(c.values['G.Neuron3.V']), len(c.time_points))
+        c.create()
+
+        c = BrianRecordingCreator('test_model_with_filters_2.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('brian_models/tutorial_model.py'), include='*.spikes', neurons=2)
+        self.assertEqual(len(c.values), 2)
+        c.create()
+
 
 if __name__ == '__main__':
     unittest.main()  # automatically executes all methods above that start with 'test_'
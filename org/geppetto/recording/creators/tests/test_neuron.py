@@ -1,8 +1,28 @@
 import unittest
+import distutils.spawn
 import os
-from org.geppetto.recording.creators import NeuronRecordingCreator
+import shutil
+import subprocess
+import sys
+import tempfile
+import h5py
+import numpy as np
+from org.geppetto.recording.creators import NeuronRecordingCreator, MetaType
+from org.geppetto.recording.creators.utils import ParseCache
 from org.geppetto.recording.creators.tests.abstest import AbstractTestCase
 
+# Records a distributed model on all ranks, run with mpiexec (arguments: recording file, model file).
+_DISTRIBUTED_RECORDING_SCRIPT = """
+import sys
+from neuron import h
+h.nrnmpi_init()
+from org.geppetto.recording.creators import NeuronRecordingCreator
+c = NeuronRecordingCreator(sys.argv[1])
+c.record_model(sys.argv[2], tstop=20, distributed=range(2))
+c.create()
+h.quit()  # finalizes MPI
+"""
+
 
 class NeuronRecordingCreatorTestCase(AbstractTestCase):
     """Unittests for the NeuronRecordingCreator class."""
@@ -39,6 +59,25 @@ class NeuronRecordingCreatorTestCase(AbstractTestCase):
         self.assertAlmostEquals(c.time_points, [0, 0.025, 0.05, 0.075])
         c.create()
 
+    def test_text_recording_with_cache(self):
+        cache_directory = tempfile.mkdtemp()
+        try:
+            cache = ParseCache(cache_directory)
+            for i in range(2):  # the second time, the data is read from the cache
+                c = NeuronRecordingCreator('test_text_recording_with_cache_{0}.h5'.format(i))
+                self.register_recording_creator(c)
+                c.add_text_recording(os.path.abspath('neuron_recordings/text/graph_gui.dat'), variable_units=['ms', 'mV'],
+                                     cache=cache)
+                self.assertAlmostEquals(c.values['soma.segmentAt0_5.v'], [-65, -65.0156, -65.0244, -65.0285])
+                self.assertAlmostEquals(c.time_points, [0, 0.025, 0.05, 0.075])
+                self.assertEqual(len(os.listdir(cache_directory)), 1)
+                c.create()
+
+            ParseCache(cache_directory, max_size=0).evict()  # least recently used entries are removed
+            self.assertEqual(os.listdir(cache_directory), [])
+        finally:
+            shutil.rmtree(cache_directory)
+
     def test_binary_recording(self):
         c = NeuronRecordingCreator('test_binary_recording.h5')
         self.register_recording_creator(c)
@@ -59,6 +98,159 @@ class NeuronRecordingCreatorTestCase(AbstractTestCase):
         # TODO: Make test model shorter and run assertEquals.
         c.create()
 
+    def test_model_with_filters(self):
+        c = NeuronRecordingCreator('test_model_with_filters.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/sthB.hoc'), include=['soma.*.v', '*.hh.*'], exclude='*.hh.gnabar',
+                       sections='soma', mechanisms='hh')
+        self.assertIn('soma.segment0.v', c.values)
+        self.assertIn('soma.segment0.hh.m', c.values)
+        self.assertNotIn('soma.segment0.hh.gnabar', c.values)
+        self.assertNotIn('soma.segment0.cm', c.values)
+        self.assertNotIn('soma.segment0.na_ion.ina', c.values)
+        self.assertNotIn('dendrites[0].segment0.v', c.values)
+        c.create()
+
+        # Square brackets in the patterns are part of the names, not character sets
+        c = NeuronRecordingCreator('test_model_with_filters_2.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/sthB.hoc'), include='dendrites[0].*.v',
+                       exclude='dendrites[0].segment4.v', sections='dendrites[*]', record_spikes=False)
+        self.assertEqual(sorted(name for name in c.values if c.meta_types[name] == MetaType.STATE_VARIABLE),
+                         ['dendrites[0].segment{0}.v'.format(i) for i in range(4)])
+        c.create()
+
+    def test_model_statistics(self):
+        c = NeuronRecordingCreator('test_model_statistics.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/sthB.hoc'))
+        # Attributes were only looked up once for each kind of object: sections, segments with hh or pas,
+        # the mechanisms hh, pas, na_ion and k_ion, and the point process IClamp.
+        self.assertEqual(c.statistics['discovered_object_kinds'], 8)
+        self.assertTrue(c.statistics['setup_time'] >= 0)
+        self.assertEqual(c.statistics['recorded_variables'], len([name for name in c.values if c.meta_types[name] == MetaType.STATE_VARIABLE]))
+        c.create()
+
+    def test_model_with_constants(self):
+        c = NeuronRecordingCreator('test_model_with_constants.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/sthB.hoc'), sections='soma', constant_tolerance=0)
+        self.assertEqual(c.meta_types['soma.segment0.hh.gnabar'], MetaType.PROPERTY)
+        self.assertAlmostEquals(c.values['soma.segment0.hh.gnabar'], [0.25])
+        self.assertEqual(c.meta_types['soma.segment0.v'], MetaType.STATE_VARIABLE)
+        self.assertEqual(len(c.values['soma.segment0.v']), len(c.time_points))
+        self.assertTrue(c.statistics['constant_variables'] > 0)
+        self.assertEqual(c.statistics['saved_values'], c.statistics['constant_variables'] * (len(c.time_points) - 1))
+        c.create()
+
+    def test_model_with_flush(self):
+        c = NeuronRecordingCreator('test_model_with_flush.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/sthB.hoc'), tstop=5, sections='soma', flush_interval=1.3)
+        self.assertEqual(c.flushed_lengths['soma.segment0.v'], c.num_flushed_time_points)
+        self.assertEqual(c.values['soma.segment0.v'], [])
+        c.create()
+        with h5py.File(c.filename, 'r') as f:
+            self.assertEqual(len(f['time']), 201)  # same as a single run for 5 ms with dt = 0.025 ms
+            self.assertAlmostEquals(f['time'][-1], 5.0)
+            self.assertEqual(len(f['soma/segment0/v']), len(f['time']))
+        self.assertRaises(ValueError, NeuronRecordingCreator('test_model_with_flush_2.h5').record_model,
+                          os.path.abspath('neuron_models/sthB.hoc'), constant_tolerance=0, flush_interval=1)
+
+    def test_model_with_record_intervals(self):
+        c = NeuronRecordingCreator('test_model_with_record_intervals.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/sthB.hoc'), tstop=5, sections='soma',
+                       record_intervals=[('*.v', 0.1), ('*_ion.*', 1)])
+        self.assertEqual(len(c.time_points), 201)
+        self.assertAlmostEquals(c.time_axes['time_0_1ms'][:3], [0, 0.1, 0.2])
+        self.assertEqual(len(c.values['soma.segment0.v']), 51)
+        self.assertEqual(c.variable_time_axes['soma.segment0.v'], 'time_0_1ms')
+        self.assertEqual(len(c.values['soma.segment0.na_ion.ena']), 6)
+        self.assertEqual(len(c.values['soma.segment0.hh.m']), 201)
+        c.create()
+
+    def test_model_with_cvode(self):
+        c = NeuronRecordingCreator('test_model_with_cvode.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/spikes.hoc'), tstop=20, sections='cell', cvode=True)
+        self.assertTrue(len(set(np.diff(c.time_points).round(6))) > 1)  # adaptive time steps
+        self.assertEqual(len(c.values['cell.segment0.v']), len(c.time_points))
+        c.create()
+
+        c = NeuronRecordingCreator('test_model_with_cvode_resampled.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/spikes.hoc'), tstop=20, sections='cell', cvode=True,
+                       resample_time_step=0.5)
+        self.assertAlmostEquals(c.time_points[:3], [0, 0.5, 1])
+        self.assertEqual(len(c.values['cell.segment0.v']), len(c.time_points))
+        c.create()
+
+    def test_model_with_spikes(self):
+        c = NeuronRecordingCreator('test_model_with_spikes.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/spikes.hoc'), tstop=20, sections='cell')
+        self.assertEqual(c.meta_types['cell.segment0.spikes'], MetaType.EVENT)
+        self.assertTrue(len(c.values['cell.segment0.spikes']) > 0)
+        self.assertEqual(c.meta_types['NetStim[0].spikes'], MetaType.EVENT)
+        self.assertAlmostEquals(c.values['NetStim[0].spikes'], [1, 6, 11])
+        self.assertAlmostEquals(c.values['cell.segment0.IClamp[0].amp'][0], 0.5)
+        self.assertEqual(c.statistics['recorded_spike_sources'], 2)
+        c.create()
+
+    def test_model_isolated(self):
+        c = NeuronRecordingCreator('test_model_isolated.h5')
+        self.register_recording_creator(c)
+        c.record_model(os.path.abspath('neuron_models/spikes.hoc'), tstop=20, include=['cell.*.v', '*.spikes'],
+                       record_intervals={'cell.segment0.v': 0.5}, isolated=True)
+        self.assertEqual(len(c.values['cell.segment0.v']), len(c.time_axes['time_0_5ms']))
+        self.assertEqual(c.variable_time_axes['cell.segment0.v'], 'time_0_5ms')
+        self.assertEqual(c.units['NetStim[0].spikes'], 'ms')
+        self.assertEqual(c.meta_types['NetStim[0].spikes'], MetaType.EVENT)
+        self.assertAlmostEquals(list(c.values['NetStim[0].spikes']), [1, 6, 11])
+        self.assertEqual(c.statistics['recorded_spike_sources'], 2)
+        c.create()
+        self.assertRaises(ValueError, NeuronRecordingCreator('test_model_isolated_2.h5').record_model,
+                          os.path.abspath('neuron_models/spikes.hoc'), flush_interval=-1, isolated=True)
+
+    def test_distributed_model(self):
+        c = NeuronRecordingCreator('test_distributed_model.h5')
+        self.register_recording_creator(c)
+        # Run in a separate process, so the gids of the model are not registered in the ParallelContext of the tests.
+        # With mpiexec, the recording is the same for any number of ranks.
+        c.record_model(os.path.abspath('neuron_models/network.hoc'), tstop=20, distributed=range(2), isolated=True)
+        self.assertIn('gid0.soma.segment0.v', c.values)
+        self.assertIn('gid1.soma.segment0.ExpSyn[0].i', c.values)  # numbered in its cell, like on any rank
+        self.assertAlmostEquals(list(c.values['rank0.NetStim[0].spikes']), [1, 6, 11])
+        self.assertEqual(len(c.values['gid0.spikes']), 3)
+        self.assertTrue(c.values['gid1.spikes'][0] > c.values['gid0.spikes'][0])
+        c.create()
+
+    @unittest.skipIf(distutils.spawn.find_executable('mpiexec') is None, 'mpiexec is not installed')
+    def test_distributed_model_on_two_ranks(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path),
+                   # Open MPI refuses to run as root or with more ranks than CPUs otherwise
+                   OMPI_ALLOW_RUN_AS_ROOT='1', OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1', OMPI_MCA_rmaps_base_oversubscribe='1')
+        filenames = []
+        for num_ranks in (1, 2):
+            c = NeuronRecordingCreator('test_distributed_model_{0}_ranks.h5'.format(num_ranks))
+            self.register_recording_creator(c)
+            subprocess.check_call(['mpiexec', '-n', str(num_ranks), sys.executable, '-c', _DISTRIBUTED_RECORDING_SCRIPT,
+                                   c.filename, os.path.abspath('neuron_models/network.hoc')], env=env)
+            filenames.append(c.filename)
+
+        # The files of both ranks are merged into the same recording as the one of a single rank
+        with h5py.File(filenames[0], 'r') as single, h5py.File(filenames[1], 'r') as merged:
+            datasets = []
+            single.visititems(lambda path, obj: datasets.append(path) if isinstance(obj, h5py.Dataset) else None)
+            merged_datasets = []
+            merged.visititems(lambda path, obj: merged_datasets.append(path) if isinstance(obj, h5py.Dataset) else None)
+            self.assertEqual(sorted(merged_datasets), sorted(datasets))
+            self.assertIn('gid1/soma/segment0/ExpSyn[0]/i', datasets)
+            for path in datasets:
+                self.assertTrue(np.allclose(merged[path][()], single[path][()]), path)
+        self.assertFalse(os.path.exists('test_distributed_model_2_ranks.rank1.h5'))  # merged and removed
+
     def test_py_model(self):
         c = NeuronRecordingCreator('test_py_model.h5')
         self.register_recording_creator(c)
@@ -1,7 +1,13 @@
 import unittest
 import os
 import sys
+import shutil
+import tempfile
+import h5py
+import numpy as np
 from org.geppetto.recording.creators import WormSimRecordingCreator
+from org.geppetto.recording.creators.wormsim import read_transformations
+from org.geppetto.recording.creators.utils import ParseCache
 from org.geppetto.recording.creators.tests.abstest import AbstractTestCase
 
 
@@ -27,11 +33,17 @@ class WormSimRecordingCreatorTestCase(AbstractTestCase):
         self.assertEquals(c.values['wormsim.muscle_0.mechanical.SimulationTree.activation'][3], 0.576848)
 
         # Test transformations
-        length = len(c.values['wormsim.mechanical.VisualizationTree.transformation'][0])
-        self.assertEquals(c.values['wormsim.mechanical.VisualizationTree.transformation'][0][0], 1.0)
-        self.assertEquals(c.values['wormsim.mechanical.VisualizationTree.transformation'][0][length-2], -23.521)
+        transformations = c.values['wormsim.mechanical.VisualizationTree.transformation']
+        self.assertEquals(transformations[0][0][0][0], 1.0)
+        self.assertEquals(transformations[0][-1][3][2], -23.521)
+        self.assertEquals(transformations.shape, (6317, 31, 4, 4))
+        self.assertEquals(c.metadata['items_per_step'], 31 * 4 * 4)
 
         c.create()
+        with h5py.File(c.filename, 'r') as f:
+            dataset = f['wormsim/mechanical/VisualizationTree/transformation']
+            self.assertEquals(dataset.chunks, (1, 31, 4, 4))  # one time step per chunk
+            self.assertEquals(f.attrs['matrices_per_step'], 31)
 
     def test_text_recording_with_downsampling(self):
         c = WormSimRecordingCreator('test_10x_downsampled_wormsim_recording.h5')
@@ -52,11 +64,214 @@ class WormSimRecordingCreatorTestCase(AbstractTestCase):
         self.assertEquals(c.values['wormsim.muscle_0.mechanical.SimulationTree.activation'][3], 0.590158)
 
         # Test transformations
-        length = len(c.values['wormsim.mechanical.VisualizationTree.transformation'][0])
-        self.assertEquals(c.values['wormsim.mechanical.VisualizationTree.transformation'][0][0], 1.0)
-        self.assertEquals(c.values['wormsim.mechanical.VisualizationTree.transformation'][0][length-2], -23.521)
+        transformations = c.values['wormsim.mechanical.VisualizationTree.transformation']
+        self.assertEquals(transformations[0][0][0][0], 1.0)
+        self.assertEquals(transformations[0][-1][3][2], -23.521)
 
         c.create()
 
+    def test_parallel_text_recording(self):
+        serial = WormSimRecordingCreator('test_serial_wormsim_recording.h5')
+        self.register_recording_creator(serial)
+        parallel = WormSimRecordingCreator('test_parallel_wormsim_recording.h5')
+        self.register_recording_creator(parallel)
+
+        activations_directory = tempfile.mkdtemp()
+        try:
+            activations_filename = os.path.join(activations_directory, 'activations.txt')
+            np.savetxt(activations_filename, np.linspace(0, 1, 166 * 3).reshape(166, 3))
+            for c, processes in [(serial, 1), (parallel, 3)]:
+                c.add_recording(os.path.abspath('wormsim_recordings/transformations/matrix_anchored_31S_'),
+                                activations_filename, 65, 165, 1, 4, processes=processes)
+        finally:
+            shutil.rmtree(activations_directory)
+
+        # Transformations are in the order of the steps, no matter which process read them
+        serial_transformations = serial.values['wormsim.mechanical.VisualizationTree.transformation']
+        parallel_transformations = parallel.values['wormsim.mechanical.VisualizationTree.transformation']
+        self.assertEquals(len(parallel_transformations), 101)
+        self.assertTrue(np.array_equal(serial_transformations, parallel_transformations))
+        self.assertEquals(list(parallel_transformations[0][0][0]), [1.0, 0.0, 0.0, 0.0])
+
+        serial.create()
+        parallel.create()
+
+    def test_invalid_transformation_file(self):
+        transforms_directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(transforms_directory, 'activations.txt'), 'w') as f:
+                f.write('0.1 0.2\n0.3 0.4\n')
+            for filename, text in [('matrix_0.mat', '1 0\n0 1\n\n'), ('matrix_1.mat', '1 0\n0 one\n\n')]:
+                with open(os.path.join(transforms_directory, filename), 'w') as f:
+                    f.write(text)
+            c = WormSimRecordingCreator('test_invalid_wormsim_recording.h5')
+            # Parsing stops at the word, this must not go unnoticed
+            self.assertRaisesRegexp(ValueError, 'matrix_1.mat, found text that is not a number after 3 values',
+                                    c.add_recording, os.path.join(transforms_directory, 'matrix_'),
+                                    os.path.join(transforms_directory, 'activations.txt'), 0, 1, 1, 2)
+        finally:
+            shutil.rmtree(transforms_directory)
+
+    def test_activations_as_matrix(self):
+        c = WormSimRecordingCreator('test_wormsim_activations_as_matrix.h5')
+        self.register_recording_creator(c)
+
+        activations_directory = tempfile.mkdtemp()
+        try:
+            activations_filename = os.path.join(activations_directory, 'activations.txt')
+            all_activations = np.arange(6400 * 3).reshape(6400, 3) / 1000.0  # one line per step, more than needed
+            np.savetxt(activations_filename, all_activations)
+            c.add_recording(os.path.abspath('wormsim_recordings/transformations/matrix_anchored_31S_'),
+                            activations_filename, 65, 6381, 10, 4, activations_as_matrix=True)
+        finally:
+            shutil.rmtree(activations_directory)
+
+        activations = c.values['wormsim.mechanical.SimulationTree.muscle_activations']
+        self.assertEquals(len(activations), len(range(65, 6382, 10)))
+        # Only the lines of the steps in range, every 10th one
+        self.assertTrue(np.array_equal(activations, all_activations[65:6382:10]))
+        self.assertEquals(c.values['wormsim.mechanical.SimulationTree.muscle_activations_names'][0],
+                          'wormsim.muscle_0.mechanical.SimulationTree.activation')
+        self.assertEquals(list(c.get_activation_signal('wormsim.muscle_0.mechanical.SimulationTree.activation')[:4]),
+                          [0.195, 0.225, 0.255, 0.285])
+        self.assertNotIn('wormsim.muscle_0.mechanical.SimulationTree.activation', c.values)
+
+        c.create()
+        with h5py.File(c.filename, 'r') as f:
+            self.assertEquals(len(f['time']), len(activations))
+            self.assertEquals(f['wormsim/mechanical/SimulationTree/muscle_activations'].shape, activations.shape)
+
+    def test_text_recording_with_cache(self):
+        temporary_directory = tempfile.mkdtemp()
+        try:
+            activations_filename = os.path.join(temporary_directory, 'activations.txt')
+            np.savetxt(activations_filename, np.linspace(0, 1, 1066 * 3).reshape(1066, 3))
+            uncached = WormSimRecordingCreator('test_uncached_wormsim_recording.h5')
+            self.register_recording_creator(uncached)
+            uncached.add_recording(os.path.abspath('wormsim_recordings/transformations/matrix_anchored_31S_'),
+                                   activations_filename, 65, 1065, 10, 4, activations_as_matrix=True)
+
+            cache_directory = os.path.join(temporary_directory, 'cache')
+            cache = ParseCache(cache_directory)
+            # Steps that were cached by the first call are reused by the others, new steps are added to the cache
+            for i, (step_start, sampling_factor) in enumerate([(65, 20), (65, 10), (65, 10)]):
+                c = WormSimRecordingCreator('test_cached_wormsim_recording_{0}.h5'.format(i))
+                self.register_recording_creator(c)
+                c.add_recording(os.path.abspath('wormsim_recordings/transformations/matrix_anchored_31S_'),
+                                activations_filename, step_start, 1065, sampling_factor, 4, activations_as_matrix=True,
+                                cache=cache)
+                c.create()
+            for name in ['wormsim.mechanical.VisualizationTree.transformation',
+                         'wormsim.mechanical.SimulationTree.muscle_activations']:
+                self.assertTrue(np.array_equal(c.values[name], uncached.values[name]))
+            # One entry for the activation signals, and one for the series of transformations
+            self.assertEquals(len(os.listdir(cache_directory)), 2)
+            # Arrays of different lengths cannot be rows of a series
+            filenames = [os.path.abspath('wormsim_recordings/transformations/matrix_anchored_31S_0006{0}.mat'.format(i))
+                         for i in (5, 6)]
+            self.assertRaises(ValueError, cache.get_series, filenames, lambda filenames: [np.zeros(2), np.zeros(3)],
+                              ('ragged',))
+        finally:
+            shutil.rmtree(temporary_directory)
+
+        uncached.create()
+
+    def test_rigid_transformation_encoding(self):
+        # Rotations around the z axis with translations, one matrix of step 5 is scaled
+        transformations = np.zeros((20, 2, 4, 4))
+        angles = np.linspace(0, np.pi, 40).reshape(20, 2)
+        transformations[:, :, 0, 0] = transformations[:, :, 1, 1] = np.cos(angles)
+        transformations[:, :, 0, 1] = np.sin(angles)
+        transformations[:, :, 1, 0] = -np.sin(angles)
+        transformations[:, :, 2, 2] = 1
+        transformations[:, :, 3, :3] = np.arange(20 * 2 * 3).reshape(20, 2, 3)
+        transformations[:, :, 3, 3] = 1
+        transformations[5, 1, :3, :3] *= 1.5
+
+        transforms_directory = tempfile.mkdtemp()
+        try:
+            activations_filename = os.path.join(transforms_directory, 'activations.txt')
+            np.savetxt(activations_filename, np.linspace(0, 1, 20 * 3).reshape(20, 3))
+            for i, step_transformations in enumerate(transformations):
+                with open(os.path.join(transforms_directory, 'matrix_{0:05d}.mat'.format(i)), 'w') as f:
+                    for matrix in step_transformations:
+                        f.write('\n'.join(' '.join(map(repr, row)) for row in matrix) + '\n\n')
+
+            c = WormSimRecordingCreator('test_rigid_wormsim_recording.h5')
+            self.register_recording_creator(c)
+            c.add_recording(os.path.join(transforms_directory, 'matrix_'), activations_filename,
+                            0, 19, 1, 4, processes=1, transform_encoding='rigid')
+        finally:
+            shutil.rmtree(transforms_directory)
+
+        self.assertEquals(c.values['wormsim.mechanical.VisualizationTree.transformation'].shape, (19, 2, 7))
+        self.assertEquals(len(c.values['wormsim.mechanical.VisualizationTree.transformation_matrices']), 1)
+        self.assertEquals(list(c.values['wormsim.mechanical.VisualizationTree.transformation_rows'][4:7]), [4, -1, 5])
+        c.create()
+
+        self.assertTrue(np.allclose(read_transformations(c.filename), transformations))
+        self.assertTrue(np.allclose(read_transformations(c.filename, [5, 6, 8]), transformations[[5, 6, 8]]))
+        self.assertEquals(read_transformations(c.filename, slice(2, 4)).shape, (2, 2, 4, 4))
+
+    def test_keyframe_encoding(self):
+        c = WormSimRecordingCreator('test_keyframe_wormsim_recording.h5')
+        self.register_recording_creator(c)
+        activations_directory = tempfile.mkdtemp()
+        try:
+            activations_filename = os.path.join(activations_directory, 'activations.txt')
+            np.savetxt(activations_filename, np.linspace(0, 1, 365 * 3).reshape(365, 3))
+            c.add_recording(os.path.abspath('wormsim_recordings/transformations/matrix_anchored_31S_'),
+                            activations_filename, 65, 364, 1, 4, activations_as_matrix=True, keyframe_interval=10)
+        finally:
+            shutil.rmtree(activations_directory)
+        transformations = np.array(c.values['wormsim.mechanical.VisualizationTree.transformation'])
+        os.mkdir(c.filename)  # the first write fails
+        try:
+            self.assertRaises(IOError, c.create)
+        finally:
+            os.rmdir(c.filename)
+        self.assertTrue(np.array_equal(c.values['wormsim.mechanical.VisualizationTree.transformation'],
+                                       transformations))  # not encoded twice when the write is retried
+        c.create()
+
+        with h5py.File(c.filename, 'r') as f:
+            dataset = f['wormsim/mechanical/VisualizationTree/transformation']
+            self.assertEquals(dataset.compression, 'gzip')
+            self.assertEquals(f.attrs['keyframe_interval'], 10)
+            self.assertEquals(f['wormsim/mechanical/VisualizationTree/transformation_keyframes'].shape, (30, 31, 4, 4))
+            # Keyframes are exact, the other steps are rounded to half the quantum
+            decoded = read_transformations(f)
+            self.assertTrue(np.array_equal(decoded[::10], transformations[::10]))
+            self.assertTrue(np.abs(decoded - transformations).max() <= 0.5e-6 + 1e-12)
+            # Steps between keyframes are decoded from their own row and the previous keyframe
+            self.assertTrue(np.array_equal(read_transformations(f, [299, 10, 15, 0, 15]), decoded[[299, 10, 15, 0, 15]]))
+
+    def test_estimate_recording(self):
+        c = WormSimRecordingCreator('test_estimate_wormsim_recording.h5')
+        estimate = c.estimate_recording(os.path.abspath('wormsim_recordings/transformations/matrix_anchored_31S_'),
+                                        65, 6381, 10, 4)
+        self.assertEquals(estimate['steps'], len(range(65, 6382, 10)))
+        self.assertEquals(estimate['values_per_step'], 31 * 4 * 4)
+        self.assertEquals(estimate['output_bytes'], estimate['steps'] * 31 * 4 * 4 * 8)
+        self.assertTrue(estimate['input_bytes'] > 0)
+
+    def test_missing_steps(self):
+        transforms_directory = tempfile.mkdtemp()
+        try:
+            activations_filename = os.path.join(transforms_directory, 'activations.txt')
+            np.savetxt(activations_filename, np.zeros((8, 2)))
+            # Step numbers with any padding, steps 3, 4 and 7 are missing
+            for filename in ['matrix_0.mat', 'matrix_01.mat', 'matrix_002.mat', 'matrix_5.mat', 'matrix_00006.mat']:
+                with open(os.path.join(transforms_directory, filename), 'w') as f:
+                    f.write('1 0\n0 1\n\n')
+            c = WormSimRecordingCreator('test_missing_steps_wormsim_recording.h5')
+            self.assertEquals(c.estimate_recording(os.path.join(transforms_directory, 'matrix_'), 0, 2, 1, 2)['steps'], 3)
+            self.assertRaisesRegexp(IOError, 'steps 3-4, 7$', c.add_recording,
+                                    os.path.join(transforms_directory, 'matrix_'), activations_filename, 0, 7, 1, 2)
+            self.assertEquals(c.values, {})  # failed before anything was added
+        finally:
+            shutil.rmtree(transforms_directory)
+
+
 if __name__ == '__main__':
     unittest.main()  # automatically executes all methods above that start with 'test_'
@@ -1,10 +1,38 @@
 """Utility functions for org.geppetto.recording."""
 
+import ast
+import cPickle
+import fnmatch
+import hashlib
 import os
+import re
 import runpy
 import string
+import subprocess
 import sys
+import tempfile
 import math
+import zipfile
+import numpy as np
+
+
+# Executed by a fresh Python interpreter in `run_isolated`.
+_ISOLATED_CALL_SCRIPT = """
+import sys
+import cPickle
+function, args, kwargs = cPickle.load(sys.stdin)
+try:
+    result = (True, function(*args, **kwargs))
+except Exception as e:
+    result = (False, e)
+with open(sys.argv[1], 'wb') as f:
+    try:
+        cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+    except Exception:  # the exception could not be pickled
+        f.seek(0)
+        f.truncate()
+        cPickle.dump((False, RuntimeError(repr(result[1]))), f, cPickle.HIGHEST_PROTOCOL)
+"""
 
 
 def is_text_file(filename):
@@ -32,19 +60,93 @@ def make_iterable(object):
         return [object]
 
 
-def run_as_script(filename):
-    """Run a Python file as if it would be run from the command line (with name __main__ and its working directory)."""
+def matches_any(name, patterns):
+    """Return `True` if `name` matches at least one of the shell-style wildcard patterns (see `fnmatch`).
+
+    Only * and ? are wildcards. Square brackets match themselves, because they are part of many names (like the
+    NEURON section *dend[0]*).
+
+    """
+    return any(fnmatch.fnmatchcase(name, _escape_brackets(pattern)) for pattern in make_iterable(patterns))
+
+
+def _escape_brackets(pattern):
+    """Return a `fnmatch` pattern in which square brackets are no character sets."""
+    return re.sub(r'[\[\]]', r'[\g<0>]', pattern)
+
+
+def run_as_script(filename, parameters=None):
+    """Run a Python file as if it would be run from the command line (with name __main__ and its working directory).
+
+    `parameters` maps names to Python expressions (as strings). Top-level assignments to these names in the file,
+    like ``tau = 20 * ms``, assign the value of the expression instead. Raises ValueError if the file does not assign
+    one of the names at the top level.
+
+    """
     abspath = os.path.abspath(filename)
     dirname = os.path.dirname(abspath)
     sys.path.append(dirname)
     old_cwd = os.getcwd()
     os.chdir(dirname)
-    vars_dict = runpy.run_path(abspath, run_name='__main__')
-    os.chdir(old_cwd)
-    sys.path.remove(dirname)
+    try:
+        if parameters:
+            # runpy has no public function to run a code object as __main__
+            vars_dict = runpy._run_module_code(_compile_with_parameters(abspath, parameters), mod_name='__main__',
+                                               mod_fname=abspath)
+        else:
+            vars_dict = runpy.run_path(abspath, run_name='__main__')
+    finally:  # also restore the working directory and path if the script fails
+        os.chdir(old_cwd)
+        sys.path.remove(dirname)
     return vars_dict
 
 
+def _compile_with_parameters(filename, parameters):
+    """Compile a Python file, with the expressions in `parameters` assigned instead of the file's values."""
+    with open(filename, 'r') as f:
+        tree = ast.parse(f.read(), filename)
+    unassigned = set(parameters)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in parameters:
+                node.value = ast.copy_location(ast.parse(parameters[name], '<parameter ' + name + '>', 'eval').body,
+                                               node.value)
+                unassigned.discard(name)
+    if unassigned:
+        raise ValueError("Model file does not assign the parameters " + ', '.join(sorted(unassigned)) +
+                         " at the top level: " + filename)
+    return compile(ast.fix_missing_locations(tree), filename, 'exec')
+
+
+def run_isolated(function, *args, **kwargs):
+    """Call `function(*args, **kwargs)` in a fresh Python interpreter and return its result.
+
+    Nothing that happens during the call (like loading a model into a simulator) affects the calling process.
+    The function, its arguments, its result and any exception it raises have to be picklable (so the function
+    must be defined at module level). The calling thread waits for the result, other threads can start isolated
+    calls in parallel.
+
+    """
+    fd, result_filename = tempfile.mkstemp(suffix='.pickle')
+    os.close(fd)
+    try:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)  # to find the module of `function`
+        process = subprocess.Popen([sys.executable, '-c', _ISOLATED_CALL_SCRIPT, result_filename],
+                                   stdin=subprocess.PIPE, env=env)
+        process.communicate(cPickle.dumps((function, args, kwargs), cPickle.HIGHEST_PROTOCOL))
+        if process.returncode != 0:
+            raise RuntimeError("Isolated process exited with code {0} while calling {1}".format(process.returncode, function.__name__))
+        with open(result_filename, 'rb') as f:
+            succeeded, result = cPickle.load(f)
+    finally:
+        os.remove(result_filename)
+    if not succeeded:
+        raise result
+    return result
+
+
 def split_by_separators(s, separators=(' ', ',', ';', '\t')):
     """Split a string by all elements in `separators` (or any combination) and return a list of the substrings."""
     if not hasattr(separators, '__iter__'):
@@ -101,4 +203,153 @@ def pad_number(number, padding):
 
     result += str(number)
 
-    return result
\ No newline at end of file
+    return result
+
+
+class ParseCache(object):
+    """An on-disk cache for arrays parsed from text files.
+
+    Arrays are stored as .npy files (series of arrays as .npz files) in `directory`, keyed by the path, size and
+    modification time of the file they were parsed from (and by the parse options), so a file is parsed again as soon
+    as it changes. Cached arrays are memory-mapped when they are reused. If the cache grows beyond `max_size` bytes,
+    the least recently used entries are deleted. The same directory can be used by several runs and processes.
+
+    Parameters
+    ----------
+    directory : string
+        The directory of the cache files, will be created if it does not exist.
+    max_size : int, optional
+        The maximum size of all cache files in bytes (default: 1 GB).
+
+    """
+
+    def __init__(self, directory, max_size=2**30):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def _identity(filename):
+        """Return the absolute path, size and modification time of a file."""
+        stat = os.stat(filename)
+        return os.path.abspath(filename), stat.st_size, stat.st_mtime
+
+    def _entry_filename(self, key, extension='.npy'):
+        """Return the path of the cache file for a key (any tuple of strings and numbers)."""
+        return os.path.join(self.directory, hashlib.sha1(repr(key)).hexdigest() + extension)
+
+    def _write(self, filename, write):
+        """Call `write(file)` on a temporary file and move it to `filename` when done, so readers never see parts."""
+        fd, temp_filename = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            if os.path.exists(filename):  # os.rename does not replace files on Windows
+                os.remove(filename)
+            os.rename(temp_filename, filename)
+        except Exception:
+            os.remove(temp_filename)
+            raise
+
+    def get(self, filename, parse, key=None):
+        """Return the array parsed from a file, call `parse()` only if it is not in the cache.
+
+        Parameters
+        ----------
+        filename : string
+            The file the array is parsed from.
+        parse : callable
+            Parses the file and returns the array.
+        key : tuple, optional
+            Options that change the result of `parse` (like the columns to parse).
+
+        Returns
+        -------
+        numpy.ndarray
+            The parsed array (read-only and memory-mapped if it was cached).
+
+        """
+        entry_filename = self._entry_filename((self._identity(filename), key))
+        try:
+            array = np.load(entry_filename, mmap_mode='r')
+        except (IOError, ValueError):  # not cached yet or incomplete
+            array = np.asarray(parse())
+            self._write(entry_filename, lambda f: np.save(f, array))
+            self.evict()
+        else:
+            os.utime(entry_filename, None)  # mark as recently used
+        return array
+
+    def get_series(self, filenames, parse_all, key):
+        """Return the arrays parsed from many files of the same kind as one array with a row per file.
+
+        All arrays of a series are kept in a single .npz cache file together with the identities of their files, so
+        adding many small files is not slower than parsing them. Files that are not in the cache yet are parsed and
+        appended to the series. Unlike single arrays, a series is read into memory and not memory-mapped.
+
+        Parameters
+        ----------
+        filenames : iterable of strings
+            The files the arrays are parsed from.
+        parse_all : callable
+            Parses a list of files and returns an iterable with one 1-dimensional array of the same length per file
+            (ValueError is raised if the lengths differ).
+        key : tuple
+            Identifies the series (like the filename base and the parse options).
+
+        Returns
+        -------
+        numpy.ndarray
+            The parsed arrays, one row per file (in the order of `filenames`).
+
+        """
+        entry_filename = self._entry_filename(key, '.npz')
+        # The rows and the identities of their files are in one file, so they are always replaced together
+        index = {}
+        data = None
+        try:
+            with np.load(entry_filename) as entry:
+                data = entry['rows']
+                index = dict(((path, size, mtime), row) for row, (path, size, mtime) in
+                             enumerate(zip(entry['paths'], entry['sizes'], entry['mtimes'])))
+        except (IOError, ValueError, KeyError, zipfile.BadZipfile):  # not cached yet or unreadable
+            pass
+
+        identities = [self._identity(filename) for filename in filenames]
+        if not identities:
+            return np.empty((0, 0))
+        missing = sorted(set(identity for identity in identities if identity not in index))
+        if missing:
+            new_rows = list(parse_all([identity[0] for identity in missing]))
+            row_shape = np.shape(new_rows[0]) if data is None else data.shape[1:]
+            for identity, row in zip(missing, new_rows):
+                if len(row_shape) != 1 or np.shape(row) != row_shape:
+                    raise ValueError("Cannot cache " + identity[0] + " in a series, its array has another shape "
+                                     "than the ones of the other files")
+            num_old_rows = len(index)
+            index.update((identity, num_old_rows + i) for i, identity in enumerate(missing))
+            data = np.array(new_rows) if data is None else np.concatenate((data, new_rows))
+            paths, sizes, mtimes = zip(*sorted(index, key=index.get))
+            self._write(entry_filename, lambda f: np.savez(f, rows=data, paths=paths, sizes=sizes, mtimes=mtimes))
+            self.evict()
+        else:
+            os.utime(entry_filename, None)  # mark as recently used
+        return data[[index[identity] for identity in identities]]
+
+    def evict(self):
+        """Delete the least recently used cache entries until the cache is not larger than `max_size`."""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if os.path.splitext(filename)[1] in ('.npy', '.npz'):
+                stat = os.stat(os.path.join(self.directory, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        total_size = sum(size for last_used, size, filename in entries)
+        for last_used, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:  # removed by another process
+                pass
+            total_size -= size
@@ -1,10 +1,258 @@
 from __future__ import absolute_import
+import contextlib
+import functools
+import itertools
+import multiprocessing
+import os
+import re
+import h5py
 import numpy as np
 from org.geppetto.recording.creators import utils
 from org.geppetto.recording.creators.base import RecordingCreator, MetaType
 from org.geppetto.recording.creators.utils import *
 
 
+def _parse_values(text, filename):
+    """Return all numbers in `text` as an array, separated by whitespace, commas or semicolons."""
+    for separator in (',', ';', '\t'):
+        text = text.replace(separator, ' ')
+    values = np.fromstring(text, sep=' ')
+    # fromstring stops silently at the first value that is not a number
+    if len(values) != len(text.split()):
+        raise ValueError("Could not parse " + filename + ", found text that is not a number after {0} values".format(
+            len(values)))
+    return values
+
+
+def _parse_rows(lines, filename):
+    """Return the numbers in `lines` as a matrix with one row per line."""
+    if not lines:
+        return np.empty((0, 0))
+    values = _parse_values(' '.join(lines), filename)
+    if len(values) % len(lines):
+        raise ValueError("Lines in " + filename + " have different numbers of values")
+    return values.reshape(len(lines), -1)
+
+
+def _read_activations(filename):
+    """Return all activation signals in a file as a (time steps x muscles) matrix."""
+    with open(filename, 'r') as r:
+        return _parse_rows(r.read().splitlines(), filename)
+
+
+def _activation_name(muscle):
+    """Return the name of the variable with the activation signal of one muscle."""
+    return 'wormsim.muscle_' + str(muscle) + '.mechanical.SimulationTree.activation'
+
+
+def _format_steps(steps):
+    """Return sorted step numbers as a short string of ranges like *3-5, 8*."""
+    ranges = []
+    for step in sorted(steps):
+        if ranges and step == ranges[-1][1] + 1:
+            ranges[-1][1] = step
+        else:
+            ranges.append([step, step])
+    return ', '.join(str(first) if first == last else '{0}-{1}'.format(first, last) for first, last in ranges)
+
+
+def _index_step_files(transforms_filename):
+    """Return a dict that maps step numbers to the files named `transforms_filename` + step (any padding) + *.mat*.
+
+    The directory is listed only once.
+
+    """
+    directory, prefix = os.path.split(transforms_filename)
+    pattern = re.compile(re.escape(prefix) + r'(\d+)\.mat$')
+    index = {}
+    for filename in os.listdir(directory or os.curdir):
+        match = pattern.match(filename)
+        if match:
+            step = int(match.group(1))
+            if step in index:
+                raise IOError("Several transformation files for step {0}: {1} and {2}".format(
+                    step, os.path.basename(index[step]), filename))
+            index[step] = os.path.join(directory, filename)
+    return index
+
+
+def _read_transformations(filename, transform_matrix_dimension):
+    """Return all values of a transformation file as an array, without the separator line after each matrix."""
+    if not is_text_file(filename):
+        raise StandardError("Transformations file " + filename + " is not a text file as expected.")
+    with open(filename, 'r') as r:
+        lines = r.read().splitlines()
+    # Skip one line every transform_matrix_dimension lines, then parse the rest at once.
+    del lines[transform_matrix_dimension::transform_matrix_dimension + 1]
+    return _parse_values(' '.join(lines), filename)
+
+
+def _read_all_transformations(filenames, transform_matrix_dimension, processes):
+    """Yield the values of each transformation file in order, read by `processes` processes in parallel."""
+    read = functools.partial(_read_transformations, transform_matrix_dimension=transform_matrix_dimension)
+    if processes > 1 and len(filenames) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            # imap keeps the order of the files
+            for values in pool.imap(read, filenames, chunksize=max(1, len(filenames) // (4 * processes))):
+                yield values
+        finally:
+            pool.terminate()
+    else:
+        for filename in filenames:
+            yield read(filename)
+
+
+def _stack_transformations(all_transformations, filenames, transform_matrix_dimension):
+    """Return the values of all files as one (steps x matrices x dimension x dimension) array.
+
+    Each step is a contiguous frame. Returns `None` if there are no files.
+
+    """
+    matrix_size = transform_matrix_dimension * transform_matrix_dimension
+    transformations = None
+    for j, step_transformations in enumerate(all_transformations):
+        if transformations is None:
+            if len(step_transformations) % matrix_size:
+                raise ValueError("Transformations file " + filenames[j] +
+                                 " does not contain whole matrices of the given dimension")
+            transformations = np.empty((len(filenames), len(step_transformations) // matrix_size,
+                                        transform_matrix_dimension, transform_matrix_dimension))
+        if len(step_transformations) != transformations[j].size:
+            raise ValueError("Transformations file " + filenames[j] +
+                             " contains a different number of values than the previous ones")
+        transformations[j].flat = step_transformations
+    return transformations
+
+
+def _encode_rigid(transformations, tolerance, dtype):
+    """Encode 4 x 4 matrices as quaternion (w, x, y, z) plus translation, and check which steps are rigid.
+
+    The matrices transform row vectors (rotation in the upper left 3 x 3 block, translation in the last row).
+    Returns the (steps x matrices x 7) encoding and a boolean array that is `True` for each step whose matrices are
+    all reproduced by the encoding within `tolerance`.
+
+    """
+    # Rotation matrices for column vectors
+    r = np.swapaxes(transformations[..., :3, :3], -1, -2)
+    encoded = np.empty(transformations.shape[:-2] + (7,))
+    encoded[..., 0] = np.sqrt(np.maximum(0, 1 + r[..., 0, 0] + r[..., 1, 1] + r[..., 2, 2])) / 2
+    encoded[..., 1] = np.sqrt(np.maximum(0, 1 + r[..., 0, 0] - r[..., 1, 1] - r[..., 2, 2])) / 2
+    encoded[..., 2] = np.sqrt(np.maximum(0, 1 - r[..., 0, 0] + r[..., 1, 1] - r[..., 2, 2])) / 2
+    encoded[..., 3] = np.sqrt(np.maximum(0, 1 - r[..., 0, 0] - r[..., 1, 1] + r[..., 2, 2])) / 2
+    encoded[..., 1] = np.copysign(encoded[..., 1], r[..., 2, 1] - r[..., 1, 2])
+    encoded[..., 2] = np.copysign(encoded[..., 2], r[..., 0, 2] - r[..., 2, 0])
+    encoded[..., 3] = np.copysign(encoded[..., 3], r[..., 1, 0] - r[..., 0, 1])
+    encoded[..., 4:] = transformations[..., 3, :3]
+    encoded = encoded.astype(dtype)
+
+    # Everything but the translation has to survive a round trip
+    error = np.abs(_decode_rigid(encoded) - transformations)
+    error[..., 3, :3] = 0
+    is_rigid = error.reshape(len(transformations), -1).max(axis=1) <= tolerance
+    return encoded, is_rigid
+
+
+def _decode_rigid(encoded):
+    """Return the 4 x 4 matrices of transformations encoded by `_encode_rigid`."""
+    w, x, y, z = [encoded[..., i].astype(float) for i in range(4)]
+    matrices = np.zeros(encoded.shape[:-1] + (4, 4))
+    # Transposed rotation matrix of the quaternion, for row vectors
+    matrices[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    matrices[..., 1, 0] = 2 * (x * y - z * w)
+    matrices[..., 2, 0] = 2 * (x * z + y * w)
+    matrices[..., 0, 1] = 2 * (x * y + z * w)
+    matrices[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    matrices[..., 2, 1] = 2 * (y * z - x * w)
+    matrices[..., 0, 2] = 2 * (x * z - y * w)
+    matrices[..., 1, 2] = 2 * (y * z + x * w)
+    matrices[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    matrices[..., 3, :3] = encoded[..., 4:]
+    matrices[..., 3, 3] = 1
+    return matrices
+
+
+def _encode_keyframes(values, keyframe_interval, delta_quantum):
+    """Return the keyframes (every `keyframe_interval`-th row) and all rows as differences to their previous keyframe.
+
+    The keyframes keep their full precision. The differences are integer multiples of `delta_quantum` (zero for the
+    keyframes themselves), which compress much better than the values.
+
+    """
+    values = np.asarray(values)
+    keyframes = values[::keyframe_interval]
+    keyframe_rows = np.arange(len(values)) // keyframe_interval
+    deltas = np.round((values - keyframes[keyframe_rows]) / delta_quantum).astype(np.int64)
+    return deltas, keyframes
+
+
+def _take_rows(dataset, rows):
+    """Read rows of a dataset in any order, also several times."""
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    if len(unique_rows) > len(dataset) // 2:
+        values = dataset[()][unique_rows]
+    else:
+        values = dataset[list(unique_rows)]  # h5py reads only increasing rows without duplicates
+    return values[inverse]
+
+
+def _read_rows(dataset, rows, attrs):
+    """Read rows of a dataset (in any order) as floats, and decode keyframes and deltas if needed."""
+    rows = np.asarray(rows, dtype=int)
+    if not len(rows):
+        return np.empty((0,) + dataset.shape[1:])
+    values = _take_rows(dataset, rows).astype(float)
+    keyframe_interval = attrs.get('keyframe_interval', 0)
+    if keyframe_interval:
+        keyframes = _take_rows(dataset.file[dataset.name + '_keyframes'], rows // keyframe_interval)
+        values = values * attrs['delta_quantum'] + keyframes
+    return values
+
+
+def read_transformations(recording, steps=None, name='wormsim.mechanical.VisualizationTree.transformation'):
+    """Read the visual transformations of a recording file as matrices, in any encoding.
+
+    Only the rows that are needed for the steps are read, so reading a few steps of a large recording is fast.
+
+    Parameters
+    ----------
+    recording : string or h5py.File
+        The recording file (or its path) created by `WormSimRecordingCreator`.
+    steps : slice or sequence of integers, optional
+        The time steps to read. If `None` (default), read all time steps.
+    name : string, optional
+        The name of the variable with the transformations.
+
+    Returns
+    -------
+    numpy.ndarray
+        The transformations as (steps x matrices x dimension x dimension) array.
+
+    """
+    if not isinstance(recording, h5py.Group):
+        with h5py.File(recording, 'r') as f:
+            return read_transformations(f, steps, name)
+    path = name.replace('.', '/')
+    if steps is None:
+        steps = slice(None)
+    attrs = recording.attrs
+    if attrs.get('transform_encoding', 'matrix') == 'matrix':
+        return _read_rows(recording[path], np.atleast_1d(np.arange(len(recording[path]))[steps]), attrs)
+
+    # Rigid encoding: rows >= 0 are in the encoded dataset, rows < 0 in the full matrices for non-rigid steps
+    rows = np.atleast_1d(recording[path + '_rows'][()][steps])
+    encoded = recording[path]
+    full_matrices = recording[path + '_matrices']
+    dimension = full_matrices.shape[-1]
+    transformations = np.empty((len(rows), encoded.shape[1], dimension, dimension))
+    is_rigid = rows >= 0
+    if np.any(is_rigid):
+        transformations[is_rigid] = _decode_rigid(_read_rows(encoded, rows[is_rigid], attrs))
+    if not np.all(is_rigid):
+        transformations[~is_rigid] = _read_rows(full_matrices, -rows[~is_rigid] - 1, attrs)
+    return transformations
+
+
 class WormSimRecordingCreator(RecordingCreator):
     """
     A RecordingCreator that builds a recording file given SPH derived visual transformations and activation signals.
@@ -12,6 +260,11 @@ class WormSimRecordingCreator(RecordingCreator):
     Visual transformations are derived from a particle based simulation using the pipeline stored in this git repo:
     - https://github.com/openworm/skeletonExtraction
 
+    Activation signals are stored either as one variable per muscle (like
+    *wormsim.muscle_0.mechanical.SimulationTree.activation*) or as a single (time steps x muscles) matrix
+    *wormsim.mechanical.SimulationTree.muscle_activations*. In the latter case, the PROPERTY
+    *wormsim.mechanical.SimulationTree.muscle_activations_names* holds the per-muscle variable name of each column.
+
     Parameters
     ----------
     filename : string
@@ -23,13 +276,24 @@ class WormSimRecordingCreator(RecordingCreator):
 
     def __init__(self, filename, overwrite=False):
         RecordingCreator.__init__(self, filename, 'SPH', overwrite)
+        self.keyframe_interval = None
+        self.delta_quantum = None
+        self.statistics = {}
 
     def add_recording(self,
                       transforms_filename,
                       activations_filename,
                       step_start, step_end,
                       sampling_factor,
-                      transform_matrix_dimension):
+                      transform_matrix_dimension,
+                      processes=1,
+                      activations_as_matrix=False,
+                      cache=None,
+                      transform_encoding='matrix',
+                      rigid_tolerance=1e-6,
+                      transform_dtype=float,
+                      keyframe_interval=None,
+                      delta_quantum=1e-6):
         """
 
         Parameters
@@ -46,6 +310,34 @@ class WormSimRecordingCreator(RecordingCreator):
             Sampling factor for original source (i.e. 1 = all the steps, 10 = 1 steps every 10, etc.).
         transform_matrix_dimension : integer
             Dimension of the transformation matrix (always quadratic).
+        processes : integer, optional
+            Number of processes that read the transformation files in parallel. If 1 (default), read all files in
+            this process. If `None`, use one process per CPU.
+        activations_as_matrix : boolean, optional
+            If `True`, parse only the lines of the activation signals file for the steps in range and store them as a
+            single (time steps x muscles) matrix (see class description). If `False` (default), store one variable
+            per muscle.
+        cache : utils.ParseCache, optional
+            If given, keep the parsed transformation files and activation signals in this cache, so later calls
+            with the same files (and any step range or sampling factor) do not have to parse them again.
+        transform_encoding : {'matrix', 'rigid'}, optional
+            If 'matrix' (default), store all transformation matrices as they are. If 'rigid', store each matrix as
+            quaternion plus translation (7 instead of 16 numbers, only for dimension 4). Time steps with a matrix that
+            is not a rigid transformation within `rigid_tolerance` are stored as full matrices in the variable
+            *transformation_matrices*; the variable *transformation_rows* holds the row of each step in one of both.
+            Use `read_transformations` to get the matrices back.
+        rigid_tolerance : float, optional
+            The largest difference between a matrix and its rigid encoding (default: 1e-6).
+        transform_dtype : numpy dtype, optional
+            The data type of the stored transformations (default: float64), `numpy.float32` halves the size.
+        keyframe_interval : integer, optional
+            If given, store every `keyframe_interval`-th time step (of each encoding) as a keyframe with full precision,
+            and all steps as difference to their previous keyframe in integer multiples of `delta_quantum`, and compress
+            them. Any step can be decoded from its own row and one keyframe. If `None` (default), store the values as
+            they are.
+        delta_quantum : float, optional
+            The precision of the keyframe encoding (default: 1e-6), the differences to the keyframes are rounded to
+            multiples of it. Each stored value is at most `delta_quantum` / 2 off, keyframes are exact.
 
         Returns
         -------
@@ -54,6 +346,23 @@ class WormSimRecordingCreator(RecordingCreator):
 
         """
         self._assert_not_created()
+        if transform_encoding not in ('matrix', 'rigid'):
+            raise ValueError("Unknown transform encoding: " + str(transform_encoding))
+        if transform_encoding == 'rigid' and transform_matrix_dimension != 4:
+            raise ValueError("Rigid encoding needs a transform matrix dimension of 4")
+        if self.metadata.get('transform_encoding', transform_encoding) != transform_encoding:
+            raise ValueError("Transform encoding does not match with a previous recording")
+        if keyframe_interval is not None and keyframe_interval < 1:
+            raise ValueError("Keyframe interval must be at least 1")
+        if self.keyframe_interval is not None and (keyframe_interval, delta_quantum) != (self.keyframe_interval,
+                                                                                        self.delta_quantum):
+            raise ValueError("Keyframe interval does not match with a previous recording")
+
+        # Find all transformation files first, so missing files are reported before anything is parsed
+        transform_filenames, estimate = self._index_recording(transforms_filename, step_start, step_end,
+                                                              sampling_factor, transform_matrix_dimension,
+                                                              transform_dtype)
+        self.statistics.update(estimate)
 
         # Set metadata
         self.add_metadata('version', 1)
@@ -62,57 +371,208 @@ class WormSimRecordingCreator(RecordingCreator):
         # Set time step
         self.set_time_step(0.000005*sampling_factor, 's')
 
-        # Read activation signals into a list of arrays
-        activation_signals = []
-        if is_text_file(activations_filename):  # text format for activation signals file
+        # Time steps in range, one every sampling_factor steps
+        steps = range(step_start, step_end+1, sampling_factor)
+
+        if not is_text_file(activations_filename):  # Raise exception
+            raise StandardError("Activation signals file is not a text file as expected.")
+        if activations_as_matrix and not steps:
+            raise ValueError("No time steps in range")
+        if cache is not None:
+            # Parse the whole file once, later calls slice the cached matrix
+            activation_signals = cache.get(activations_filename, functools.partial(_read_activations,
+                                                                                   activations_filename))
+            if activations_as_matrix:
+                activation_signals = activation_signals[step_start:step_end+1:sampling_factor]
+        elif activations_as_matrix:
+            # Tokenize only the lines of the steps in range, and stop reading after the last one.
+            with open(activations_filename, 'r') as r:
+                lines = list(itertools.islice(r, step_start, step_end+1, sampling_factor))
+            activation_signals = _parse_rows(lines, activations_filename)
+        else:
+            # Read activation signals into a list of arrays
+            activation_signals = []
             with open(activations_filename, 'r') as r:
                 file_content = r.read()
             for i, line in enumerate(file_content.splitlines()):
                 # convert retrieved values into float and append
                 activation_signals.append([float(numeric_string) for numeric_string in utils.split_by_separators(line)])
-        else:  # Raise exception
-            raise StandardError("Activation signals file is not a text file as expected.")
+        if activations_as_matrix and len(activation_signals) < len(steps):
+            raise ValueError("Activation signals file has no line for step " + str(steps[len(activation_signals)]))
+
+        # Read the transformation files of all time steps in range (one per file)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        read_all = functools.partial(_read_all_transformations, transform_matrix_dimension=transform_matrix_dimension,
+                                     processes=processes)
+        if cache is not None:
+            all_transformations = cache.get_series(transform_filenames, read_all,
+                                                   ('transformations', os.path.abspath(transforms_filename),
+                                                    transform_matrix_dimension))
+            transformations = _stack_transformations(all_transformations, transform_filenames,
+                                                     transform_matrix_dimension)
+        else:
+            with contextlib.closing(read_all(transform_filenames)) as all_transformations:
+                transformations = _stack_transformations(all_transformations, transform_filenames,
+                                                         transform_matrix_dimension)
 
-        # Loop through time steps (one per file) in range, run one loop every sampling_factor
-        for i in range(step_start, step_end+1, sampling_factor):
+        if transformations is not None:
+            name = 'wormsim.mechanical.VisualizationTree.transformation'
+            self.add_metadata('items_per_step', transformations[0].size)
+            self.add_metadata('matrices_per_step', len(transformations[0]))
+            self.add_metadata('transform_encoding', transform_encoding)
+            if keyframe_interval is not None:
+                # Encoded when the file is created, so keyframes are counted over all added steps
+                self.keyframe_interval = keyframe_interval
+                self.delta_quantum = delta_quantum
+                self.add_metadata('keyframe_interval', keyframe_interval)
+                self.add_metadata('delta_quantum', delta_quantum)
+            if transform_encoding == 'rigid':
+                encoded, is_rigid = _encode_rigid(transformations, rigid_tolerance, transform_dtype)
+                num_encoded = len(self.values.get(name, []))
+                num_full = len(self.values.get(name + '_matrices', []))
+                rows = np.empty(len(transformations), dtype=int)
+                rows[is_rigid] = num_encoded + np.arange(np.count_nonzero(is_rigid))
+                rows[~is_rigid] = -1 - (num_full + np.arange(np.count_nonzero(~is_rigid)))
+                self.add_values(name, encoded[is_rigid], 'DimensionlessUnit', MetaType.VISUAL_TRANSFORMATION)
+                self.add_values(name + '_matrices', np.asarray(transformations[~is_rigid], dtype=transform_dtype),
+                                'DimensionlessUnit', MetaType.VISUAL_TRANSFORMATION)
+                self.add_values(name + '_rows', rows, '', MetaType.PROPERTY)
+            else:
+                self.add_values(name, np.asarray(transformations, dtype=transform_dtype), 'DimensionlessUnit',
+                                MetaType.VISUAL_TRANSFORMATION)
 
-            step_transformations = []
+        if activations_as_matrix:
+            # Activation signals for all time steps, muscle names as column index
+            name = 'wormsim.mechanical.SimulationTree.muscle_activations'
+            if not self._variable_exists(name + '_names'):
+                self.add_values(name + '_names', [_activation_name(m) for m in range(activation_signals.shape[1])],
+                                '', MetaType.PROPERTY)
+            self.add_values(name, activation_signals, 'DimensionlessUnit', MetaType.STATE_VARIABLE)
+        else:
+            # Activation signals for each time step by muscle name
+            for i in steps:
+                for m in range(0, len(activation_signals[i])):
+                    self.add_values(_activation_name(m), activation_signals[i][m], 'DimensionlessUnit',
+                                    MetaType.STATE_VARIABLE)
 
-            # generate suffix for filename (based on arbitrary padding on file names ... )
-            transform_file_suffix = utils.pad_number(i, 3) + '.mat'
+        return self
 
-            # Read transformation file for the given time step
-            if is_text_file(transforms_filename + transform_file_suffix):  # text format for activation signals file
-                with open(transforms_filename + transform_file_suffix, 'r') as r:
-                    file_content = r.read()
+    def _process_added_data(self, f):
+        """Check all added data for consistency and write it to file, encode transformations with keyframes if needed.
 
-                line_periodicity_idx = 0
-                for j, line in enumerate(file_content.splitlines()):
+        Keyframes are stored next to each encoded variable (with the suffix *_keyframes*). The added values are not
+        changed, so a failed write can be retried.
 
-                    # skip one line every transform_matrix_dimension lines
-                    if line_periodicity_idx == (transform_matrix_dimension):
-                        line_periodicity_idx = 0
-                        continue
+        """
+        if self.keyframe_interval is None:
+            RecordingCreator._process_added_data(self, f)
+            return
+        values = self.values
+        self.values = dict(values)
+        try:
+            all_keyframes = {}
+            for name in values:
+                if self.meta_types[name] == MetaType.VISUAL_TRANSFORMATION and len(values[name]):
+                    self.values[name], all_keyframes[name] = _encode_keyframes(values[name], self.keyframe_interval,
+                                                                               self.delta_quantum)
+                    self.dataset_options[name] = {'compression': 'gzip', 'shuffle': True}
+            RecordingCreator._process_added_data(self, f)
+        finally:
+            self.values = values
+        for name, keyframes in all_keyframes.iteritems():
+            path = name.replace('.', '/')
+            f.create_dataset(path + '_keyframes', data=keyframes, chunks=(1,) + keyframes.shape[1:],
+                             **self.dataset_options[name])
+            for attr_name, value in f[path].attrs.iteritems():
+                f[path + '_keyframes'].attrs[attr_name] = value
+
+    def _index_recording(self, transforms_filename, step_start, step_end, sampling_factor, transform_matrix_dimension,
+                         transform_dtype=float):
+        """Find the transformation files of all steps and estimate the size of their data (see `estimate_recording`).
 
-                    # convert to float and append
-                    step_transformations.extend([float(numeric_string) for numeric_string in utils.split_by_separators(line)])
+        Returns the filenames (one per step) and the estimate.
 
-                    # increase periodicity index
-                    line_periodicity_idx += 1
-            else:  # Raise exception
-                raise StandardError("Transformations file " + i + " is not a text file as expected.")
+        """
+        steps = range(step_start, step_end+1, sampling_factor)
+        index = _index_step_files(transforms_filename)
+        missing_steps = [i for i in steps if i not in index]
+        if missing_steps:
+            raise IOError("No transformation files {0}*.mat for steps {1}".format(transforms_filename,
+                                                                                   _format_steps(missing_steps)))
+        transform_filenames = [index[i] for i in steps]
+        file_sizes = np.array([os.path.getsize(filename) for filename in transform_filenames], dtype=np.int64)
+        if np.any(file_sizes == 0):
+            raise IOError("Empty transformation files for steps " +
+                          _format_steps(np.array(steps)[file_sizes == 0]))
 
-            items_per_step = len(step_transformations) / transform_matrix_dimension*transform_matrix_dimension
-            custom_metadata = "dimension={0};items_per_step={1}".format(transform_matrix_dimension, items_per_step)
+        # All steps contain the same number of values, the first file tells how many
+        values_per_step = 0
+        if steps:
+            values_per_step = len(_read_transformations(transform_filenames[0], transform_matrix_dimension))
+        transformation_bytes = len(steps) * values_per_step * np.dtype(transform_dtype).itemsize
+        estimate = {
+            'steps': len(steps),
+            'input_bytes': int(file_sizes.sum()),
+            'values_per_step': values_per_step,
+            'output_bytes': transformation_bytes,
+            # the parsed array (always float64) and its copy in the creator
+            'memory_bytes': len(steps) * values_per_step * 8 + transformation_bytes,
+        }
+        return transform_filenames, estimate
 
-            # Add step values to recording with data for given timestep
-            # 1. Transformation matrices for given timestep
-            self.add_values('wormsim.mechanical.VisualizationTree.transformation',
-                            step_transformations, 'DimensionlessUnit',
-                            MetaType.VISUAL_TRANSFORMATION, True, custom_metadata)
-            # 2. Activation signals for given timestep by muscle name
-            for m in range(0, len(activation_signals[i])):
-                self.add_values('wormsim.muscle_' + str(m) + '.mechanical.SimulationTree.activation',
-                                activation_signals[i][m], 'DimensionlessUnit', MetaType.STATE_VARIABLE)
+    def estimate_recording(self, transforms_filename, step_start, step_end, sampling_factor,
+                           transform_matrix_dimension, transform_dtype=float):
+        """Check that all transformation files exist, and estimate the size of the transformations to add.
 
-        return self
\ No newline at end of file
+        This lists the directory of the transformation files once (the step numbers in their names can have any
+        padding), reads the size of each file and parses only the first one. It raises an IOError that names all
+        missing steps if there are gaps. `add_recording` does the same before it parses any file, and stores the
+        estimate in `statistics`.
+
+        Parameters
+        ----------
+        transforms_filename : string
+            Path to the file + filename base for the files with visual transformations.
+        step_start : integer
+            Starting timestep index.
+        step_end : integer
+            Ending timestep index.
+        sampling_factor : integer
+            Sampling factor for original source (i.e. 1 = all the steps, 10 = 1 steps every 10, etc.).
+        transform_matrix_dimension : integer
+            Dimension of the transformation matrix (always quadratic).
+        transform_dtype : numpy dtype, optional
+            The data type of the stored transformations (default: float64).
+
+        Returns
+        -------
+        dict
+            Number of *steps*, size of all transformation files (*input_bytes*), number of *values_per_step*,
+            size of the stored transformations without encoding or compression (*output_bytes*), and the memory
+            that is needed to add them (*memory_bytes*).
+
+        """
+        return self._index_recording(transforms_filename, step_start, step_end, sampling_factor,
+                                     transform_matrix_dimension, transform_dtype)[1]
+
+    def get_activation_signal(self, name):
+        """Return the activation signal of a muscle by its per-muscle variable name, in either storage mode.
+
+        Parameters
+        ----------
+        name : string
+            Name like *wormsim.muscle_0.mechanical.SimulationTree.activation*.
+
+        Returns
+        -------
+        list or numpy.ndarray
+            The values added so far for each time step.
+
+        """
+        if self._variable_exists(name):
+            return self.values[name]
+        matrix_name = 'wormsim.mechanical.SimulationTree.muscle_activations'
+        if self._variable_exists(matrix_name + '_names') and name in self.values[matrix_name + '_names']:
+            return self.values[matrix_name][:, self.values[matrix_name + '_names'].index(name)]
+        raise KeyError("No activation signal: " + name)
@@ -0,0 +1,89 @@
+"""Compare the time of BrianRecordingCreator.record_model with the former implementation based on `sys.settrace`.
+
+Usage:
+    python benchmark_brian.py baseline_revision [repeats]
+
+Records the Brette_2007 models from the test directory with both implementations and prints the best time of each.
+The former implementation is loaded from git at `baseline_revision`, the last one that traced the model file:
+
+    python benchmark_brian.py $(git log -1 --format=%h^ -S sys.settrace -- :/org/geppetto/recording/creators/brian.py)
+
+Each run happens in a separate process, because Brian keeps global state between simulations.
+
+"""
+import sys
+import os
+import imp
+import multiprocessing
+import subprocess
+import tempfile
+import time
+
+# add the directory to the python code to system path, so it can also be used without installation
+root_directory = os.path.abspath(__file__ + '/../..')
+os.environ.setdefault('MPLBACKEND', 'Agg')  # the models plot their results, don't open windows
+sys.path.insert(0, root_directory)
+from org.geppetto.recording.creators import BrianRecordingCreator
+
+MODULE_PATH = 'org/geppetto/recording/creators/brian.py'
+MODELS_DIRECTORY = os.path.join(root_directory, 'org/geppetto/recording/creators/tests/brian_models/Brette_2007')
+MODELS = ['CUBA.py', 'COBA.py', 'COBAHH.py']
+
+
+def load_baseline(revision):
+    """Return the brian creator module from a git revision."""
+    source = subprocess.check_output(['git', 'show', revision + ':' + MODULE_PATH], cwd=root_directory)
+    module = imp.new_module('brian_baseline')
+    module.__file__ = revision + ':' + MODULE_PATH
+    exec compile(source, module.__file__, 'exec') in module.__dict__
+    return module
+
+
+def time_recording(model_filename, baseline_revision=None):
+    """Record a model and return the time in seconds, without writing the recording."""
+    if baseline_revision:
+        module = load_baseline(baseline_revision)  # keep a reference, Python 2 clears the globals of a deleted module
+        creator_class = module.BrianRecordingCreator
+    else:
+        creator_class = BrianRecordingCreator
+    handle, recording_filename = tempfile.mkstemp('.h5')
+    os.close(handle)
+    os.remove(recording_filename)
+    creator = creator_class(recording_filename)
+    start = time.time()
+    creator.record_model(model_filename)
+    return time.time() - start
+
+
+def best_time(model_filename, repeats, baseline_revision=None):
+    """Return the best time of several recordings, each in a fresh process."""
+    times = []
+    for i in range(repeats):
+        pool = multiprocessing.Pool(1)
+        try:
+            times.append(pool.apply(time_recording, (model_filename, baseline_revision)))
+        finally:
+            pool.terminate()
+            pool.join()
+    return min(times)
+
+
+def main(argv):
+    if not argv:
+        sys.exit(__doc__)
+    baseline_revision = argv[0]
+    repeats = int(argv[1]) if len(argv) > 1 else 3
+    load_baseline(baseline_revision)  # fail here for an unknown revision, the pool hangs on errors from git
+    results = []
+    for model in MODELS:
+        model_filename = os.path.join(MODELS_DIRECTORY, model)
+        results.append((model, best_time(model_filename, repeats, baseline_revision),
+                        best_time(model_filename, repeats)))
+    # print the table at the end, the models write to stdout too
+    print '{0:<10} {1:>12} {2:>12} {3:>8}'.format('Model', 'settrace [s]', 'current [s]', 'Speedup')
+    for model, baseline, current in results:
+        print '{0:<10} {1:>12.2f} {2:>12.2f} {3:>7.1f}x'.format(model, baseline, current, baseline / current)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,94 @@
+"""Compare the time of WormSimRecordingCreator.add_recording with the former line-by-line parser.
+
+Usage:
+    python benchmark_wormsim.py baseline_revision [repeats] [activations_filename]
+
+Reads the WormSim recording from the test directory (all 6317 steps) with the former implementation, and with the
+current one in a single process and (on machines with several CPUs) with one process per CPU. Prints the best time of
+each. The former implementation is loaded from git at `baseline_revision`, the last one that parsed the transformation
+files line by line:
+
+    python benchmark_wormsim.py $(git log --reverse --format=%h^ -S _read_transformations | head -1)
+
+The activation signals are read from `activations_filename`, one line per step, or from a temporary file with random
+signals if it is not given.
+
+"""
+import sys
+import os
+import imp
+import multiprocessing
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+# add the directory to the python code to system path, so it can also be used without installation
+root_directory = os.path.abspath(__file__ + '/../..')
+sys.path.insert(0, root_directory)
+from org.geppetto.recording.creators import WormSimRecordingCreator
+
+MODULE_PATH = 'org/geppetto/recording/creators/wormsim.py'
+RECORDING_DIRECTORY = os.path.join(root_directory, 'org/geppetto/recording/creators/tests/wormsim_recordings')
+TRANSFORMS_FILENAME = os.path.join(RECORDING_DIRECTORY, 'transformations/matrix_anchored_31S_')
+STEP_START = 65
+STEP_END = 6381
+NUM_MUSCLES = 95
+
+
+def load_baseline(revision):
+    """Return the wormsim creator module from a git revision."""
+    source = subprocess.check_output(['git', 'show', revision + ':' + MODULE_PATH], cwd=root_directory)
+    module = imp.new_module('wormsim_baseline')
+    module.__file__ = revision + ':' + MODULE_PATH
+    exec compile(source, module.__file__, 'exec') in module.__dict__
+    return module
+
+
+def write_activations(activations_filename):
+    """Write random activation signals for all steps up to the last one of the test recording."""
+    np.savetxt(activations_filename, np.random.random_sample((STEP_END + 1, NUM_MUSCLES)), fmt='%g')
+
+
+def best_time(creator_class, repeats, activations_filename, **options):
+    """Return the best time of several calls to `add_recording` with the test recording."""
+    times = []
+    for i in range(repeats):
+        creator = creator_class('benchmark_wormsim_recording.h5')  # never created, so it is not written
+        start = time.time()
+        creator.add_recording(TRANSFORMS_FILENAME, activations_filename, STEP_START, STEP_END, 1, 4, **options)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(argv):
+    if not argv:
+        sys.exit(__doc__)
+    baseline_revision = argv[0]
+    repeats = int(argv[1]) if len(argv) > 1 else 3
+    baseline = load_baseline(baseline_revision)
+    activations_directory = None
+    if len(argv) > 2:
+        activations_filename = argv[2]
+    else:
+        activations_directory = tempfile.mkdtemp()
+        activations_filename = os.path.join(activations_directory, 'activations.txt')
+        write_activations(activations_filename)
+    try:
+        processes = multiprocessing.cpu_count()
+        results = [('line by line', best_time(baseline.WormSimRecordingCreator, repeats, activations_filename)),
+                   ('1 process', best_time(WormSimRecordingCreator, repeats, activations_filename, processes=1))]
+        if processes > 1:
+            results.append(('{0} processes'.format(processes),
+                            best_time(WormSimRecordingCreator, repeats, activations_filename, processes=processes)))
+    finally:
+        if activations_directory is not None:
+            shutil.rmtree(activations_directory)
+    print '{0:<14} {1:>8} {2:>8}'.format('Parser', 'Time [s]', 'Speedup')
+    for name, seconds in results:
+        print '{0:<14} {1:>8.2f} {2:>7.1f}x'.format(name, seconds, results[0][1] / seconds)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,5 +1,9 @@
 import sys
 import os
+import multiprocessing
+import shlex
+import time
+import traceback
 
 # add the directory to the python code to system path, so it can also be used without installation
 sys.path.insert(0, os.path.abspath(__file__ + '/../..'))
@@ -9,35 +13,248 @@ help_msg = """
 Usage:
 ------
 
-record -neuron modelfile.hoc [recordingfile.h5]
+record -neuron modelfile.hoc [recordingfile.h5] [options]
     Execute a NEURON model (.hoc or .py) and
     store the simulation data in a Geppetto recording.
 
-record -brian modelfile.py [recordingfile.h5]
+record -brian modelfile.py [recordingfile.h5] [options]
     Execute a Brian model (.py) and
     store the simulation data in a Geppetto recording.
 
+Options:
+    -include patterns
+        Record only the variables matching these comma separated wildcard
+        patterns (like soma.*.v for NEURON or P.v,*.spikes for Brian).
+    -exclude patterns
+        Do not record the variables matching these patterns.
+    -neurons N or -neurons FIRST:LAST
+        Brian only: Record a random sample of N neurons in each group,
+        or the neurons with indices FIRST to LAST-1.
+    -timestep N
+        Brian only: Record the state variables every N simulation steps.
+    -set name=value
+        Change a parameter of a Python model: the model file assigns the
+        Python expression value (like 10*ms) to the variable name instead
+        of its own value. The variable has to be assigned at the top level
+        of the model file. Repeat the option to change several parameters.
+
+record -batch manifest.txt [-workers N] [-overwrite]
+    Record all models in the manifest file without asking anything.
+    Each line of the manifest is a model with its options, like
+        -neuron cell.hoc cell_short.h5 -include soma.*.v
+        -brian network.py -neurons 100
+        -brian network.py network_slow.h5 -set taum=40*ms
+    (paths relative to the manifest, # starts a comment). List one model
+    several times with different options or parameters to sweep over them.
+    -workers N
+        Record N models at the same time (default: number of CPUs).
+    -overwrite
+        Overwrite existing recording files (default: fail these models).
+    Shows the progress and a summary of the time per model. The exit code
+    is 0 if all models were recorded, 1 if any failed, and 2 for errors
+    in the command line or manifest.
+
 record help
     Show this help message.
 """
 
 
+def parse_options(argv, simulator):
+    """Return the keyword arguments for `record_model` from the command line options."""
+    options = {}
+    if len(argv) % 2:
+        raise ValueError('Option ' + argv[-1] + ' needs a value.')
+    for option, value in zip(argv[::2], argv[1::2]):
+        if option in ('-include', '-exclude'):
+            options[option[1:]] = value.split(',')
+        elif option in ('-neurons', '-timestep') and simulator != '-brian':
+            raise ValueError('Option ' + option + ' is only available for Brian models.')
+        elif option == '-neurons':
+            if ':' in value:
+                first, last = value.split(':')
+                options['neurons'] = range(int(first), int(last))
+            else:
+                options['neurons'] = int(value)
+        elif option == '-timestep':
+            options['timestep'] = int(value)
+        elif option == '-set':
+            name, equals, expression = [part.strip() for part in value.partition('=')]
+            if not name or not equals or not _is_expression(expression):
+                raise ValueError('Please use -set name=value with a Python expression as value, not: ' + value)
+            options.setdefault('parameters', {})[name] = expression
+        else:
+            raise ValueError('Unknown option: ' + option)
+    return options
+
+
+def _is_expression(text):
+    """Return `True` if `text` is a valid Python expression."""
+    try:
+        compile(text, '<expression>', 'eval')
+    except SyntaxError:
+        return False
+    return True
+
+
+def parse_job(argv):
+    """Return the simulator option, model file, recording file and `record_model` options from the arguments."""
+    if not argv or argv[0] not in ('-neuron', '-brian'):
+        raise ValueError('Please choose -neuron or -brian.')
+    if len(argv) < 2:
+        raise ValueError('Please give me a model file.')
+    model_filename = argv[1]
+    if len(argv) > 2 and not argv[2].startswith('-'):
+        output_filename = argv[2]
+        option_args = argv[3:]
+    else:
+        output_filename = model_filename.rsplit('.', 1)[0] + '.h5'
+        option_args = argv[2:]
+    return argv[0], model_filename, output_filename, parse_options(option_args, argv[0])
+
+
+def read_manifest(manifest_filename):
+    """Return the jobs (see `parse_job`) in a manifest file, with paths relative to the manifest."""
+    directory = os.path.dirname(os.path.abspath(manifest_filename))
+    jobs = []
+    with open(manifest_filename, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+            try:
+                simulator, model_filename, output_filename, options = parse_job(argv)
+            except ValueError as e:
+                raise ValueError('Line {0} of the manifest: {1}'.format(line_number, e))
+            # normalized, so that different spellings of the same output file are found below
+            jobs.append((simulator, os.path.normpath(os.path.join(directory, model_filename)),
+                         os.path.normpath(os.path.join(directory, output_filename)), options))
+    outputs = [job[2] for job in jobs]
+    for output_filename in set(outputs):
+        if outputs.count(output_filename) > 1:
+            raise ValueError('Several models in the manifest write to ' + output_filename)
+    return jobs
+
+
+def record_job(job):
+    """Record one model in a worker process, return if it succeeded, the time it took and a message."""
+    simulator, model_filename, output_filename, options, overwrite = job
+    start_time = time.time()
+    try:
+        if simulator == '-neuron':
+            c = NeuronRecordingCreator(output_filename, overwrite=overwrite)
+        else:
+            c = BrianRecordingCreator(output_filename, overwrite=overwrite)
+        c.record_model(model_filename, **options)
+        c.create()
+    except Exception as e:
+        traceback.print_exc()
+        return False, time.time() - start_time, '{0}: {1}'.format(type(e).__name__, e)
+    return True, time.time() - start_time, ''
+
+
+def format_duration(seconds):
+    """Return a duration like 1:02:03, 2:03 or 4.5s."""
+    if seconds < 60:
+        return '{0:.1f}s'.format(seconds)
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+    return '{0}:{1:02d}'.format(minutes, seconds)
+
+
+def run_batch(argv):
+    """Record all models of a manifest on several processes and return the exit code."""
+    try:
+        manifest_filename = argv[0]
+        workers = multiprocessing.cpu_count()
+        overwrite = False
+        option_args = argv[1:]
+        while option_args:
+            if option_args[0] == '-overwrite':
+                overwrite = True
+                option_args = option_args[1:]
+            elif option_args[0] == '-workers' and len(option_args) > 1:
+                workers = int(option_args[1])
+                if workers < 1:
+                    raise ValueError('Please use at least one worker.')
+                option_args = option_args[2:]
+            else:
+                raise ValueError('Unknown batch option: ' + option_args[0])
+        jobs = read_manifest(manifest_filename)
+    except IndexError:
+        print 'Please give me a manifest file.'
+        return 2
+    except (ValueError, IOError) as e:
+        print e
+        return 2
+
+    print 'Recording {0} model(s) with {1} worker(s)...'.format(len(jobs), workers)
+    # A fresh process for each model, simulators keep their state until the process ends
+    pool = multiprocessing.Pool(min(workers, len(jobs)) or 1, maxtasksperchild=1)
+    results = [None] * len(jobs)
+    start_time = time.time()
+    try:
+        indexed_results = pool.imap_unordered(_record_indexed_job,
+                                              [(i, job + (overwrite,)) for i, job in enumerate(jobs)])
+        for num_done in range(1, len(jobs) + 1):
+            # Waiting without a timeout cannot be interrupted with Ctrl+C in Python 2
+            i, result = _next_result(indexed_results)
+            results[i] = result
+            elapsed = time.time() - start_time
+            eta = elapsed / num_done * (len(jobs) - num_done)
+            print '[{0}/{1}] {2} {3} -> {4} ({5}), ETA {6}'.format(num_done, len(jobs),
+                                                                  'done' if result[0] else 'FAILED', jobs[i][1],
+                                                                  jobs[i][2], format_duration(result[1]),
+                                                                  format_duration(eta))
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        print 'Interrupted.'
+        return 130
+    pool.close()
+    pool.join()
+
+    print ''
+    print 'Summary:'
+    for (simulator, model_filename, output_filename, options), (succeeded, duration, message) in zip(jobs, results):
+        print '  {0:>8}  {1:6}  {2} -> {3}'.format(format_duration(duration), 'ok' if succeeded else 'FAILED',
+                                                   model_filename, output_filename if succeeded else message)
+    num_failed = sum(1 for result in results if not result[0])
+    print '{0} of {1} model(s) recorded in {2}.'.format(len(jobs) - num_failed, len(jobs),
+                                                        format_duration(time.time() - start_time))
+    return 1 if num_failed else 0
+
+
+def _next_result(results):
+    """Return the next result of a pool iterator, wait in short intervals so that KeyboardInterrupt can happen."""
+    while True:
+        try:
+            return results.next(1)
+        except multiprocessing.TimeoutError:
+            pass
+
+
+def _record_indexed_job(indexed_job):
+    """Call `record_job` and return its result together with the index of the job."""
+    i, job = indexed_job
+    return i, record_job(job)
+
+
 def main(argv):
     if not argv:
         print help_msg
-    elif argv[0] == help_msg:
+    elif argv[0] == 'help':
         print help_msg
+    elif argv[0] == '-batch':
+        sys.exit(run_batch(argv[1:]))
     elif argv[0] == '-neuron' or argv[0] == '-brian':
         try:
-            model_filename = argv[1]
-        except IndexError:
-            print 'Please give me a model file.'
-            sys.exit()
-
-        try:
-            output_filename = argv[2]
-        except IndexError:
-            output_filename = model_filename.rsplit('.', 1)[0] + '.h5'
+            simulator, model_filename, output_filename, options = parse_job(argv)
+        except ValueError as e:
+            print e
+            print help_msg
+            sys.exit(2)
 
         overwrite = False
         while os.path.exists(output_filename) and not overwrite:
@@ -56,7 +273,7 @@ def main(argv):
             print '-------------------------------------------------------'
             print ''
             c = NeuronRecordingCreator(output_filename, overwrite=True)
-            c.record_model(model_filename)
+            c.record_model(model_filename, **options)
         elif argv[0] == '-brian':
             print ''
             print '------------------------------------------------------'
@@ -64,7 +281,7 @@ def main(argv):
             print '------------------------------------------------------'
             print ''
             c = BrianRecordingCreator(output_filename, overwrite=True)
-            c.record_model(model_filename)
+            c.record_model(model_filename, **options)
 
         c.create()
         print ''
@@ -81,6 +298,7 @@ def main(argv):
     else:
         print 'I do not understand that...'
         print help_msg
+        sys.exit(2)
 
 
 if __name__ == '__main__':